@@ -30,7 +30,7 @@ with open("../data/genre/kilt_titles_trie_dict.pkl", "rb") as f:
 model = GENRE.from_pretrained("../data/genre/hf_entity_disambiguation_blink").eval()
 
 
-@cache('wikipedia')
+@cache('wikipedia', memory_maxsize=2 ** 12)
 def get_wikipedia_page(name):
     return wikipedia.page(name, auto_suggest=False)
 
@@ -47,7 +47,7 @@ def link_entity_wikipedia_search(question, answer):
     return None
 
 
-@cache('link_entity_genre')
+@cache('link_entity_genre', memory_maxsize=2 ** 16)
 def link_entity_genre(question, answer, threshold=-1.5):
     sentences = [f'{question}? [START_ENT] {answer} [END_ENT]']
     entities = model.sample(
@@ -84,7 +84,7 @@ def normalize_qa(qa, link_entity_fn=link_entity_genre):
 
 
 
-@cache('wikidata_query')
+@cache('wikidata_query', memory_maxsize=2 ** 12)
 @retry(wait_exponential_multiplier=500, stop_max_attempt_number=5, wait_exponential_max=15000)
 def wikidata_query(query):
     try:
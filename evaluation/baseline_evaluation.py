@@ -3,8 +3,8 @@ import csv
 from jsonlines import jsonlines
 from tqdm import tqdm
 
-from utils.evaluation_utils import metric_max_over_ground_truths, exact_match_score_normalized, \
-    exact_match_score
+from utils.data import open_jsonl
+from utils.evaluation_utils import map_qas, score_retrieved_qas
 
 def format_qa(qa):
     out = {
@@ -37,24 +37,11 @@ def format_qa(qa):
     return out
 
 def augment_qa_em_scores(qa):
-    for k in [1, 5, 10, 50]:
-        em = any([
-            metric_max_over_ground_truths(exact_match_score_normalized, pred_answer['answer'][0], qa['answer'], qa['question'])
-            for pred_answer in qa['retrieved_qas'][:k]
-        ])
-        qa['retrieved_qa_score'] = qa['retrieved_qas'][0]['score']
-        qa[f'em_n_{k}'] = 1 if em else 0
-        em = any([
-            metric_max_over_ground_truths(exact_match_score, pred_answer['answer'][0], qa['answer_original'], qa['question'])
-            for pred_answer in qa['retrieved_qas'][:k]
-        ])
-        qa[f'em_{k}'] = 1 if em else 0
+    return score_retrieved_qas(qa, qa['answer_original'], qa['answer'])
 
-    return qa
-
-def evaluate(dataset, env):
+def evaluate(dataset, env, n_jobs=None):
     path = f'../data/results/{dataset}-{env}/baseline'
-    in_path = f'{path}/results.retrieved.jsonl'
+    in_path = f'{path}/results.retrieved.jsonl.gz'
     out_path = f'{path}/{dataset}-{env}.baseline.jsonl'
     out_path_tsv = f'{path}/{dataset}-{env}.baseline.tsv'
 
@@ -62,7 +49,7 @@ def evaluate(dataset, env):
     in_path_dataset_original = f'{path_dataset}.jsonl'
     in_path_dataset_augmented = f'{path_dataset}.augmented.jsonl'
 
-    with jsonlines.open(out_path, mode='w') as jsonl_writer, open(out_path_tsv, mode='w') as out_file_tsv, jsonlines.open(in_path) as results_reader, jsonlines.open(in_path_dataset_original) as original_dataset_reader, jsonlines.open(in_path_dataset_augmented) as augmented_dataset_reader:
+    with jsonlines.open(out_path, mode='w') as jsonl_writer, open(out_path_tsv, mode='w') as out_file_tsv, open_jsonl(in_path) as results_reader, jsonlines.open(in_path_dataset_original) as original_dataset_reader, jsonlines.open(in_path_dataset_augmented) as augmented_dataset_reader:
         fieldnames = ['id', 'question', 'answer', 'answer_alias', 'retrieved_answer', 'retrieved_qas', 'retrieved_qa_score',
                       'wikidata_entity', 'wikidata_relations', 'wikidata_relation_cardinality', 'dbpedia_relations',
                       'dbpedia_relation_cardinality', 'wikidata_entity_id', 'dbpedia_entity_id', 'wikipedia_url',
@@ -70,12 +57,15 @@ def evaluate(dataset, env):
         tsv_writer = csv.DictWriter(out_file_tsv, delimiter='\t', fieldnames=fieldnames)
         tsv_writer.writeheader()
 
-        for i, (qa_original, qa_augmented, qa_result) in enumerate(tqdm(zip(original_dataset_reader, augmented_dataset_reader, results_reader))):
-            qa = qa_augmented
-            qa['answer_original'] = qa_original['answer']
-            qa['id'] = i + 1
-            qa['retrieved_qas'] = qa_result['retrieved_qas']
-            qa = augment_qa_em_scores(qa)
+        def read_qas():
+            for i, (qa_original, qa_augmented, qa_result) in enumerate(zip(original_dataset_reader, augmented_dataset_reader, results_reader)):
+                qa = qa_augmented
+                qa['answer_original'] = qa_original['answer']
+                qa['id'] = i + 1
+                qa['retrieved_qas'] = qa_result['retrieved_qas']
+                yield qa
+
+        for qa in tqdm(map_qas(augment_qa_em_scores, read_qas(), n_jobs)):
             formatted_qa = format_qa(qa)
             tsv_writer.writerow(formatted_qa)
             jsonl_writer.write(qa)
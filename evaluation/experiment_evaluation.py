@@ -1,81 +1,120 @@
+import argparse
+import bisect
 import glob
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 from jsonlines import jsonlines
 from tqdm import tqdm
 
-from utils.cache import cache
-from utils.evaluation_utils import metric_max_over_ground_truths, exact_match_score_normalized, \
-    exact_match_score
-from utils.data import dump_json, load_json, load_jsonl
+from utils.evaluation_utils import EM_KS, answer_index_path, build_answer_index, load_answer_index, map_qas, \
+    score_retrieved_qas
+from utils.data import dump_json, file_signature, load_json, load_jsonl, load_retrieval_results, open_jsonl
+from utils.utils import unique
 
 def get_relations():
     relations = []
-    paths = glob.glob("../data/results/all/*.jsonl")
+    paths = glob.glob("../data/results/all/*.jsonl") + glob.glob("../data/results/all/*.npz")
 
     for path in paths:
-        path = path.replace(".jsonl", "")
+        path = path.replace(".jsonl", "").replace(".npz", "")
         relation = path.split('/')[-1]
         if relation.endswith('reranked'): continue
         relations.append(relation)
-    return relations
-
-
-def split_results(relations):
-    def split(relation, dataset, env, r):
-        print('Splitting',relation, dataset, env)
-        dataset_path = f'../data/annotated_datasets/datasets.augmented.jsonl'
-        in_path = f'../data/results/all/{relation}.jsonl'
-        out_path = f'../data/results/{dataset}-{env}/{relation}'
-        Path(out_path).mkdir(parents=True, exist_ok=True)
-        out_path = f'{out_path}/results.retrieved.jsonl'
-        if os.path.exists(out_path):
-            return
-
-        with jsonlines.open(out_path, mode='w') as jsonl_writer, jsonlines.open(in_path) as results_reader, jsonlines.open(dataset_path) as dataset_reader:
-            for i, (qa, qa_dataset) in enumerate(zip(results_reader, dataset_reader)):
-                if i in r:
-                    qa['input_qa'] = qa_dataset
-                    jsonl_writer.write(qa)
-
-    list = [
-        ('nq-open', 'dev', range(0, 8757)),
-        ('nq-open', 'test', range(8757, 12367)),
-        ('triviaqa', 'dev', range(12367, 21204)),
-        ('triviaqa', 'test', range(21204, 32517)),
-    ]
+    return unique(relations)
 
+
+SPLITS = [
+    ('nq-open', 'dev', range(0, 8757)),
+    ('nq-open', 'test', range(8757, 12367)),
+    ('triviaqa', 'dev', range(12367, 21204)),
+    ('triviaqa', 'test', range(21204, 32517)),
+]
+
+
+def split_path(relation, dataset, env):
+    return f'../data/results/{dataset}-{env}/{relation}/results.retrieved.jsonl.gz'
+
+
+def relation_results_path(relation):
+    in_path = f'../data/results/all/{relation}.jsonl'
+    if not os.path.exists(in_path):
+        in_path = f'../data/results/all/{relation}.npz'
+    return in_path
+
+
+def split_relation(relation):
+    """
+    Split the results of a relation into the SPLITS in a single pass over the results and the dataset, unless all
+    splits are newer than both
+    """
+    dataset_path = f'../data/annotated_datasets/datasets.augmented.jsonl'
+    in_path = relation_results_path(relation)
+    out_paths = [split_path(relation, dataset, env) for dataset, env, _ in SPLITS]
+    in_mtime = max(os.path.getmtime(in_path), os.path.getmtime(dataset_path))
+    if all(os.path.exists(out_path) and os.path.getmtime(out_path) >= in_mtime for out_path in out_paths):
+        return
+    print('Splitting', relation)
+
+    starts = [r.start for _, _, r in SPLITS]
+    with ExitStack() as stack:
+        writers = []
+        for out_path in out_paths:
+            Path(out_path).parent.mkdir(parents=True, exist_ok=True)
+            writers.append(stack.enter_context(open_jsonl(f'{out_path}.tmp.gz', mode='w')))
+        dataset_reader = stack.enter_context(jsonlines.open(dataset_path))
+
+        for i, (qa, qa_dataset) in enumerate(zip(load_retrieval_results(in_path), dataset_reader)):
+            if i >= SPLITS[-1][2].stop:
+                break
+            split = bisect.bisect_right(starts, i) - 1
+            if split >= 0 and i in SPLITS[split][2]:
+                qa['input_qa'] = qa_dataset
+                writers[split].write(qa)
+
+    for out_path in out_paths:
+        os.replace(f'{out_path}.tmp.gz', out_path)
+
+
+def split_results(relations, n_jobs=None):
+    with ProcessPoolExecutor(n_jobs) as executor:
+        list(executor.map(split_relation, relations))
+
+
+# Answer keys of the 2PAQ relation being evaluated, set before forking the workers of map_qas
+ANSWER_INDEX = {}
+
+
+def relation_qas_path(relation):
+    return f'../data/2PAQ/{relation}/{relation}.jsonl'
+
+
+def build_answer_indices(relations, n_jobs=None):
     for relation in relations:
-        for (dataset, env, r) in list:
-            split(relation, dataset, env, r)
+        qas_path = relation_qas_path(relation)
+        if os.path.exists(qas_path) and not os.path.exists(answer_index_path(qas_path)):
+            print('Building answer index', relation)
+            build_answer_index(qas_path, n_jobs)
+
+
+def load_relation_answer_index(relation):
+    ANSWER_INDEX.clear()
+    path = answer_index_path(relation_qas_path(relation))
+    if os.path.exists(path):
+        ANSWER_INDEX.update(load_answer_index(path))
 
 
 def augment_qa_em_scores(qa):
-    for k in [1, 5, 10, 50]:
-        em = any([
-            metric_max_over_ground_truths(exact_match_score_normalized, pred_answer['answer'][0], qa['answer'] + qa['answer_alias'],
-                                          qa['question'])
-            for pred_answer in qa['retrieved_qas'][:k]
-        ])
-        qa['retrieved_qa_score'] = qa['retrieved_qas'][0]['score']
-        qa[f'em_n_{k}'] = 1 if em else 0
-        em = any([
-            metric_max_over_ground_truths(exact_match_score, pred_answer['answer'][0], qa['answer'],
-                                          qa['question'])
-            for pred_answer in qa['retrieved_qas'][:k]
-        ])
-        qa[f'em_{k}'] = 1 if em else 0
-
-    return qa
-
-
-@cache('get_qas_em_2')
-def get_qas_em(relation, dataset, env):
-    print(relation, dataset, env)
-    path = f'../data/results/{dataset}-{env}/{relation}'
-    path_in = f'{path}/results.retrieved.jsonl'
+    return score_retrieved_qas(qa, qa['answer'], qa['answer'] + qa['answer_alias'], answer_index=ANSWER_INDEX)
+
+
+def get_qas(relation, dataset, env):
+    """The dataset qas of a split, with their answers split into original answers and aliases, and retrieved qas"""
+    path_in = split_path(relation, dataset, env)
     qas = []
 
     path_dataset = f'../data/annotated_datasets/{dataset}.{env}'
@@ -85,34 +124,87 @@ def get_qas_em(relation, dataset, env):
     qas_original = load_jsonl(in_path_dataset_original)
     qas_augmented = load_jsonl(in_path_dataset_augmented)
 
-    for i, (qa_augmented, qa_original, qa_result ) in enumerate(tqdm(zip(qas_augmented, qas_original, qas_results))):
+    for i, (qa_augmented, qa_original, qa_result ) in enumerate(zip(qas_augmented, qas_original, qas_results)):
         qa = qa_augmented
         answer_original = qa_original['answer']
         answer_all = qa['answer']
         qa['answer_alias'] = list(set(answer_all) - set(answer_original))
         qa['answer'] = answer_original
         qa['retrieved_qas'] = qa_result['retrieved_qas']
-        qa = augment_qa_em_scores(qa)
         qas.append(qa)
     return qas
 
 
-def evaluate(relation, dataset, env):
+SCORE_COLUMNS = [f'em_{k}' for k in EM_KS] + [f'em_n_{k}' for k in EM_KS] + ['retrieved_qa_score']
+
+
+def scores_path(relation, dataset, env):
+    return f'../data/results/{dataset}-{env}/{relation}/scores.npz'
+
+
+def score_split(relation, dataset, env, n_jobs=None):
+    """Score the retrieved qas of a split and store the scores, as one column per metric, in scores_path"""
+    print('Scoring', relation, dataset, env)
+    signature = file_signature(split_path(relation, dataset, env))
+    qas = get_qas(relation, dataset, env)
+    load_relation_answer_index(relation)
+    qas = list(tqdm(map_qas(augment_qa_em_scores, qas, n_jobs), total=len(qas)))
+
+    columns = {f'em_{k}': np.array([qa[f'em_{k}'] for qa in qas], dtype=bool) for k in EM_KS}
+    columns.update({f'em_n_{k}': np.array([qa[f'em_n_{k}'] for qa in qas], dtype=bool) for k in EM_KS})
+    columns['retrieved_qa_score'] = np.array([qa['retrieved_qa_score'] for qa in qas], dtype=np.float32)
+    path = scores_path(relation, dataset, env)
+    with open(f'{path}.tmp', 'wb') as f:
+        np.savez(f, results_signature=np.array(signature), **columns)
+    os.replace(f'{path}.tmp', path)
+    return qas
+
+
+def get_scores(relation, dataset, env, columns=SCORE_COLUMNS, n_jobs=None):
+    """
+    Load columns of the score store of a split, (re)scoring the split if its results changed since it was scored
+    """
+    path = scores_path(relation, dataset, env)
+    signature = file_signature(split_path(relation, dataset, env))
+    if os.path.exists(path):
+        with np.load(path) as scores:
+            if tuple(scores['results_signature'].tolist()) == signature:
+                return {column: scores[column] for column in columns}
+
+    score_split(relation, dataset, env, n_jobs)
+    return get_scores(relation, dataset, env, columns, n_jobs)
+
+
+def evaluation_path(relation, dataset, env):
+    return f'../data/results/{dataset}-{env}/{relation}/evaluation.json'
+
+
+def evaluation_is_current(relation, dataset, env):
+    """Whether the evaluation.json of a split is newer than all inputs of its evaluation"""
+    path = evaluation_path(relation, dataset, env)
+    if not os.path.exists(path):
+        return False
+    path_dataset = f'../data/annotated_datasets/{dataset}.{env}'
+    inputs = [relation_results_path(relation), split_path(relation, dataset, env), f'{path_dataset}.jsonl',
+              f'{path_dataset}.augmented.jsonl', answer_index_path(relation_qas_path(relation))]
+    mtime = os.path.getmtime(path)
+    return all(os.path.getmtime(p) <= mtime for p in inputs if os.path.exists(p))
+
+
+def evaluate(relation, dataset, env, n_jobs=None):
     print(relation, dataset, env)
     evaluation = {'name': relation}
-    qas = get_qas_em(relation, dataset, env)
-    path = f'../data/results/{dataset}-{env}/{relation}'
+    scores = get_scores(relation, dataset, env, [f'em_{k}' for k in EM_KS] + [f'em_n_{k}' for k in EM_KS],
+                        n_jobs=n_jobs)
 
-    for k in [1, 5, 10, 50]:
-        em = sum([qa[f'em_{k}'] for qa in qas]) / len(qas) * 100
-        evaluation[f'em_{k}'] = f'{em:.2f}'
+    for k in EM_KS:
+        evaluation[f'em_{k}'] = f'{scores[f"em_{k}"].mean() * 100:.2f}'
 
-    for k in [1, 5, 10, 50]:
-        em = sum([qa[f'em_n_{k}'] for qa in qas]) / len(qas) * 100
-        evaluation[f'em_n_{k}'] = f'{em:.2f}'
+    for k in EM_KS:
+        evaluation[f'em_n_{k}'] = f'{scores[f"em_n_{k}"].mean() * 100:.2f}'
 
     print(evaluation)
-    dump_json(evaluation, f'{path}/evaluation.json')
+    dump_json(evaluation, evaluation_path(relation, dataset, env))
     return evaluation
 
 
@@ -146,28 +238,27 @@ def format_qa(qa):
 
 def hits_and_misses(relation, dataset, env, name=None, kb='wikidata'):
     print(relation, dataset, env)
-    qas = get_qas_em(relation, dataset, env)
-    baseline_qas = get_qas_em('baseline', dataset, env)
-
-    hits = []
-    misses = []
-    mistakes = []
     k = 5
-    for i, (qa, qa_base) in enumerate(zip(qas, baseline_qas)):
-        combined_qa = {'id': i + 1,
-                       **qa,
-                       'retrieved_qas_baseline': qa_base['retrieved_qas']}
-        print(qa_base.get(f'{kb}_relations', {}))
-        print(qa_base.get(f'{kb}_relations', {}).get(relation.replace('_el','').replace('_', ' ')))
-        if name is None:
-            name = relation.replace('_el','').replace('_', ' ')
-        if (not qa[f'em_n_{k}']) and (not qa_base[f'em_n_{k}']) \
-                and qa_base.get(f'{kb}_relations', {}).get(name):
-            mistakes.append(combined_qa)
-        if qa[f'em_n_{k}'] and not qa_base[f'em_n_{k}']:
-            hits.append(combined_qa)
-        elif not qa[f'em_n_{k}'] and qa_base[f'em_n_{k}']:
-            misses.append(combined_qa)
+    em_n = get_scores(relation, dataset, env, [f'em_n_{k}', 'retrieved_qa_score'])
+    baseline_em_n = get_scores('baseline', dataset, env, [f'em_n_{k}'])[f'em_n_{k}']
+    hit_rows = np.flatnonzero(em_n[f'em_n_{k}'] & ~baseline_em_n)
+    miss_rows = np.flatnonzero(~em_n[f'em_n_{k}'] & baseline_em_n)
+    missed_rows = np.flatnonzero(~em_n[f'em_n_{k}'] & ~baseline_em_n)
+
+    qas = get_qas(relation, dataset, env)
+    baseline_qas = get_qas('baseline', dataset, env)
+    if name is None:
+        name = relation.replace('_el','').replace('_', ' ')
+
+    def combined_qa(i):
+        return {'id': i + 1,
+                **qas[i],
+                'retrieved_qa_score': float(em_n['retrieved_qa_score'][i]),
+                'retrieved_qas_baseline': baseline_qas[i]['retrieved_qas']}
+
+    hits = [combined_qa(i) for i in hit_rows.tolist()]
+    misses = [combined_qa(i) for i in miss_rows.tolist()]
+    mistakes = [combined_qa(i) for i in missed_rows.tolist() if baseline_qas[i].get(f'{kb}_relations', {}).get(name)]
     path = f'../data/results/{dataset}-{env}/{relation}'
 
     hits_f = [format_qa(qa) for qa in hits]
@@ -184,11 +275,19 @@ def load_evaluation(relation, dataset, env):
     evaluation = {**evaluation, **load_json(f'../data/results/{dataset}-{env}/{relation}/evaluation.json')}
     return evaluation
 
-def evaluate_all(relations):
-    for dataset in ['nq-open', 'triviaqa']:
-        for env in ['dev', 'test']:
-            for relation in relations:
-                evaluation = evaluate(relation, dataset, env)
+def evaluate_all(relations, workers=None, force=False):
+    """Evaluate every relation on every split in a pool of `workers` processes, skipping up to date evaluations"""
+    splits = [(relation, dataset, env) for dataset in ['nq-open', 'triviaqa'] for env in ['dev', 'test']
+              for relation in relations]
+    pending = [split for split in splits if force or not evaluation_is_current(*split)]
+    print(f'Evaluating {len(pending)} splits, {len(splits) - len(pending)} are up to date')
+
+    # Each worker scores a single split at a time, unless there is only one worker
+    n_jobs = None if workers == 1 else 1
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(evaluate, relation, dataset, env, n_jobs) for relation, dataset, env in pending]
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Evaluations', unit='split'):
+            future.result()
 
 def generate_evaluation_table(relations):
     for dataset in ['nq-open', 'triviaqa']:
@@ -206,9 +305,16 @@ def generate_evaluation_table(relations):
             pd.DataFrame(evaluations).sort_values('em_n_5_delta', ascending=False).to_csv(f'../data/results/{dataset}-{env}/evaluations.csv')
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Split, score and evaluate the retrieval results of all relations")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Number of processes to split and evaluate with, defaults to the number of cpus")
+    parser.add_argument('--force', action='store_true', help="Evaluate splits even if their evaluation is up to date")
+    args = parser.parse_args()
+
     relations = get_relations()
-    split_results(relations)
+    split_results(relations, args.workers)
+    build_answer_indices(relations)
 
-    evaluate_all(relations)
+    evaluate_all(relations, args.workers, args.force)
     generate_evaluation_table(relations)
     # hits, misses, mistakes = hits_and_misses('performer', 'nq-open', 'dev', 'performer')
@@ -1,14 +1,17 @@
+import gzip
 import re
-import sqlite3
+import shutil
+import subprocess
 import unicodedata
 import os
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
 
 from jsonlines import jsonlines
 from tqdm import tqdm
 
-from utils.cache import cache
 from utils.evaluation_utils import normalize_date
+from utils.wikidata_labels import WikidataLabels, create_label_index
 
 templates = {
     'performer': 'who sings <SUBJECT>',
@@ -63,15 +66,12 @@ relation_ids = {
     'notable_work': 'P800',
 }
 
-connection = sqlite3.connect("../data/wikidata/wikidata-labels")
+labels_path = "../data/wikidata/wikidata-labels"
+labels = WikidataLabels(labels_path)
+
 
-@cache('get_id_name_mapping')
 def get_id_name_mapping(ids):
-    cursor = connection.cursor()
-    mapping = cursor.execute("SELECT key, value FROM labels WHERE key IN (%s)" % ','.join('?' * len(ids)),
-                             ids).fetchall()
-    mapping = {m[0]: m[1] for m in mapping}
-    return mapping
+    return labels.get_many(ids)
 
 
 def normalize(text):
@@ -93,7 +93,7 @@ def generate_qa_pairs(relation):
                 subjects_ids = [t[0] for t in triplets]
                 objects_ids = [t[2] for t in triplets]
                 ids = subjects_ids + objects_ids
-                id_name_mapping = get_id_name_mapping(tuple(ids))
+                id_name_mapping = get_id_name_mapping(ids)
                 print('id_name_mapping')
                 for triplet in triplets:
                     subj_, pred, obj_ = triplet
@@ -131,18 +131,55 @@ def generate_qa_pairs(relation):
                     triplets = []
             write_triplets(triplets)
 
+PROPERTY_PREFIX = b'<http://www.wikidata.org/prop/direct/'
+
+
+@contextmanager
+def open_dump(path):
+    """Stream a gzipped dump, decompressed by pigz if it is installed and by gzip otherwise"""
+    if shutil.which('pigz') is None:
+        with gzip.open(path, 'rb') as f:
+            yield f
+        return
+
+    with subprocess.Popen(['pigz', '-dc', path], stdout=subprocess.PIPE, bufsize=2 ** 20) as process:
+        yield process.stdout
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+
+
+def extract_all_triplets(relations, dump_path='../data/wikidata/subset.nt.gz'):
+    """Extract the triplets of all relations into their .nt files, in a single pass over the dump"""
+    os.environ['PATH'] += os.pathsep + '/home/testing/drive/thymo/.local/bin' # load local packages for pigz
+    property_relations = {}
+    for relation in relations:
+        property_relations.setdefault(relation_ids[relation].encode(), []).append(relation)
+
+    with ExitStack() as stack:
+        outputs = {relation: stack.enter_context(open(f'../data/2PAQ/{relation}/{relation}.nt', 'wb'))
+                   for relation in relations}
+        dump = stack.enter_context(open_dump(dump_path))
+        for line in tqdm(dump):
+            start = line.find(PROPERTY_PREFIX)
+            if start < 0:
+                continue
+            start += len(PROPERTY_PREFIX)
+            for relation in property_relations.get(line[start:line.find(b'> ', start)], ()):
+                outputs[relation].write(line)
+
+
 def extract_triplets(relation):
-    pred = relation_ids[relation]
-    os.environ['PATH'] += os.pathsep + '/home/testing/drive/thymo/.local/bin' # load local packages for rg (ripgrep)
-    os.system(f'time rg "<http://www.wikidata.org/prop/direct/{pred}> " -z ../data/wikidata/subset.nt.gz > ../data/2PAQ/{relation}/{relation}.nt')
+    extract_all_triplets([relation])
 
 if __name__ == '__main__':
 
     relations = templates.keys()
+    create_label_index(labels_path)
 
     for relation in relations:
-        print(relation)
         Path(f'../data/2PAQ/{relation}').mkdir(parents=True, exist_ok=True)
+    extract_all_triplets(relations)
 
-        extract_triplets(relation)
+    for relation in relations:
+        print(relation)
         generate_qa_pairs(relation)
@@ -0,0 +1,123 @@
+# Measures queries/sec and recall@k of a faiss index against exact search, to choose search settings per workload
+import argparse
+import csv
+import glob
+import itertools
+import os
+import logging
+import time
+
+import faiss
+import numpy as np
+import torch
+
+from paq.retrievers.retrieve_efficient import _load_index_if_exists, mips
+
+logger = logging.getLogger(__name__)
+
+
+def load_query_embeddings(paths, n_queries):
+    """
+    The first `n_queries` rows of a list of .npy files, where a directory stands for the embeddings.<n>.npy segments
+    of a query embedding cache directory
+    """
+    files = []
+    for path in paths:
+        files += sorted(glob.glob(f'{path}/embeddings*.npy')) if os.path.isdir(path) else [path]
+
+    queries = []
+    for file in files:
+        n = n_queries - sum(len(q) for q in queries)
+        if n <= 0:
+            break
+        queries.append(np.load(file, mmap_mode='r')[:n].astype(np.float32))
+    return torch.from_numpy(np.concatenate(queries))
+
+
+def recall_at_k(top_indices, exact_top_indices, k):
+    hits = [len(np.intersect1d(approx[:k], exact[:k])) for approx, exact in zip(top_indices, exact_top_indices)]
+    return float(np.mean(hits)) / k
+
+
+def pareto_optimal(rows, x, y):
+    """Flags the rows for which no other row is at least as good on both x and y and better on one"""
+    return [
+        not any(o[x] >= r[x] and o[y] >= r[y] and (o[x] > r[x] or o[y] > r[y]) for o in rows)
+        for r in rows
+    ]
+
+
+def benchmark(index, exact_index, queries, top_ks, efsearches, batch_sizes, n_threads):
+    max_k = max(top_ks)
+    logger.info('Running exact search:')
+    exact_top_indices, _ = mips(exact_index, queries, max_k)
+
+    rows = []
+    for threads, efsearch, batch_size in itertools.product(n_threads, efsearches, batch_sizes):
+        faiss.omp_set_num_threads(threads)
+        if hasattr(index, 'hnsw'):
+            index.hnsw.efSearch = efsearch
+        mips(index, queries[:batch_size], max_k, n_queries_to_parallelize=batch_size)  # warm up
+
+        t = time.time()
+        top_indices, _ = mips(index, queries, max_k, n_queries_to_parallelize=batch_size)
+        delta = time.time() - t
+
+        row = {'efsearch': efsearch, 'batch_size': batch_size, 'threads': threads,
+               'queries_per_second': len(queries) / delta}
+        for k in top_ks:
+            row[f'recall@{k}'] = recall_at_k(top_indices, exact_top_indices, k)
+        logger.info(row)
+        rows.append(row)
+
+    for k in top_ks:
+        for row, optimal in zip(rows, pareto_optimal(rows, 'queries_per_second', f'recall@{k}')):
+            row[f'pareto@{k}'] = optimal
+    return rows
+
+
+def print_table(rows):
+    columns = list(rows[0].keys())
+    print('\t'.join(columns))
+    for row in sorted(rows, key=lambda r: -r['queries_per_second']):
+        print('\t'.join(f'{row[c]:.4f}' if isinstance(row[c], float) else str(row[c]) for c in columns))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Benchmark queries/sec and recall@k against exact search of a faiss index for a "
+                                     "grid of efSearch values, query batch sizes and thread counts")
+    parser.add_argument('--faiss_index_path', type=str, default="data/indices/multi_base_256_hnsw_sq8.faiss",
+                        help="Path to the faiss index to benchmark")
+    parser.add_argument('--precomputed_embeddings_dir', type=str, required=True,
+                        help="Directory of the vectors the index was built from, used for exact search")
+    parser.add_argument('--query_embeddings', nargs='+', type=str, required=True,
+                        help="Query embeddings in .npy format, or directories of a query embedding cache whose "
+                             "embeddings.<n>.npy segments are used")
+    parser.add_argument('--n_queries', type=int, default=2048, help="Number of queries to benchmark with")
+    parser.add_argument('--top_k', nargs='+', type=int, default=[1, 5, 10, 50])
+    parser.add_argument('--efsearch', nargs='+', type=int, default=[16, 32, 64, 128, 256, 512])
+    parser.add_argument('--n_queries_to_parallelize', nargs='+', type=int, default=[64, 256, 1024])
+    parser.add_argument('--threads', nargs='+', type=int, default=[faiss.omp_get_max_threads()])
+    parser.add_argument('--output_file', type=str, default=None, help="Path to write the results to as csv")
+    parser.add_argument('--memory_friendly_parsing', action='store_true',
+                        help='Pass this to load files more slowly, but save memory')
+    parser.add_argument('-v', '--verbose', action="store_true")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    index = _load_index_if_exists(args.faiss_index_path, None)
+    exact_index = _load_index_if_exists(None, args.precomputed_embeddings_dir, n_vectors_to_load=index.ntotal,
+                                        memory_friendly=args.memory_friendly_parsing)
+    queries = load_query_embeddings(args.query_embeddings, args.n_queries)
+
+    rows = benchmark(index, exact_index, queries, args.top_k, args.efsearch, args.n_queries_to_parallelize,
+                     args.threads)
+    print_table(rows)
+
+    if args.output_file is not None:
+        with open(args.output_file, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
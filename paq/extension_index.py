@@ -0,0 +1,187 @@
+# Builds and loads faiss indices that extend the PAQ index with 2PAQ relations
+import argparse
+import logging
+import os
+
+import faiss
+import numpy as np
+import torch
+
+from paq.retrievers.build_index import augment_vectors
+from paq.paq_utils import parse_vectors_from_directory
+from paq.retrievers.retrieval_metrics import stage
+from utils.data import dump_json, load_json
+
+logger = logging.getLogger(__name__)
+
+# Max vector norm used to build the PAQ hnsw index, extensions have to be augmented with the same value
+MAX_PHI = 42.0015
+
+
+def extension_qas_path(extension_dir, extension):
+    return f'{extension_dir}/{extension}/{extension}.jsonl'
+
+
+def parse_extension_vectors(extension_dir, extension, memory_friendly=False):
+    logger.info(f'Loading {extension} vectors from file:')
+    with stage('extension_vector_parsing'):
+        return parse_vectors_from_directory(
+            f'{extension_dir}/{extension}/vectors',
+            memory_friendly=memory_friendly,
+        ).float()
+
+
+def load_extension_vectors(extension_dir, extension, memory_friendly=False, max_phi=MAX_PHI):
+    vectors = parse_extension_vectors(extension_dir, extension, memory_friendly)
+    with stage('augment_vectors', len(vectors)):
+        return augment_vectors(vectors, max_phi=max_phi)
+
+
+def add_extensions(index, extension_dir, extensions, memory_friendly=False, max_phi=MAX_PHI):
+    for extension in extensions:
+        vectors = load_extension_vectors(extension_dir, extension, memory_friendly, max_phi)
+        with stage('index_add', len(vectors)):
+            index.add(vectors.cpu().numpy())
+    return index
+
+
+def extension_shard_path(extension_dir, extension, shard_name):
+    return f'{extension_dir}/{extension}/{extension}.{shard_name}.faiss'
+
+
+def build_compressed_shard(vectors, nlist=1024, m=16, nbits=8, opq=False, max_training_vectors=1000000):
+    """
+    Build an IVF-PQ (optionally OPQ rotated) index over augmented extension vectors. Vectors are padded to a
+    multiple of `m` dimensions. Relations too small to train the product quantizer get a flat index.
+    """
+    n, d = vectors.shape
+    if n < 39 * 2 ** nbits:
+        logger.info(f'Only {n} vectors, building a flat index instead')
+        index = faiss.IndexFlatL2(d)
+        index.add(vectors)
+        return index
+
+    d_out = -(-d // m) * m
+    nlist = min(nlist, n // 39)
+    transform = f'OPQ{m}_{d_out},' if opq else (f'Pad{d_out},' if d_out != d else '')
+    index = faiss.index_factory(d, f'{transform}IVF{nlist},PQ{m}x{nbits}', faiss.METRIC_L2)
+
+    training_vectors = vectors
+    if n > max_training_vectors:
+        training_vectors = vectors[np.sort(np.random.default_rng(0).choice(n, max_training_vectors, replace=False))]
+    with stage('index_train', len(training_vectors)):
+        index.train(training_vectors)
+    with stage('index_add', n):
+        index.add(vectors)
+    return index
+
+
+def load_extension_shard(extension_dir, extension, base_index, memory_friendly=False, max_phi=MAX_PHI,
+                         shard_name=None, nprobe=16):
+    """
+    Load an extension as its own index shard, with scores comparable to those of `base_index`.
+    A prebuilt shard `<extension>.<shard_name>.faiss` is used if it exists, otherwise a flat index is built.
+    """
+    if shard_name is not None and os.path.exists(extension_shard_path(extension_dir, extension, shard_name)):
+        with stage('index_load'):
+            shard = faiss.read_index(extension_shard_path(extension_dir, extension, shard_name))
+        if isinstance(shard, faiss.IndexPreTransform) or isinstance(shard, faiss.IndexIVF):
+            faiss.extract_index_ivf(shard).nprobe = nprobe
+        return shard
+
+    if type(base_index) == torch.Tensor:
+        return parse_extension_vectors(extension_dir, extension, memory_friendly)
+
+    if base_index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        vectors = parse_extension_vectors(extension_dir, extension, memory_friendly)
+        shard = faiss.IndexFlatIP(base_index.d)
+    else:
+        vectors = load_extension_vectors(extension_dir, extension, memory_friendly, max_phi)
+        shard = faiss.IndexFlatL2(base_index.d)
+    with stage('index_add', len(vectors)):
+        shard.add(vectors.cpu().numpy())
+    return shard
+
+
+def manifest_path(index_path):
+    return f'{index_path}.manifest.json'
+
+
+def write_merged_index(index, index_path, qas_to_retrieve_from, extension_dir, extensions, max_phi=MAX_PHI):
+    """Write an index holding PAQ plus extensions, along with a manifest of its rows"""
+    logger.info(f'Writing merged index to {index_path}')
+    faiss.write_index(index, index_path)
+    manifest = {
+        'extensions': list(extensions),
+        'max_phi': max_phi,
+        'qas_to_retrieve_from_paths': [qas_to_retrieve_from] + [extension_qas_path(extension_dir, e) for e in extensions],
+        'ntotal': index.ntotal,
+    }
+    dump_json(manifest, manifest_path(index_path))
+    return manifest
+
+
+def load_merged_index(index_path, efsearch=128, mmap=True):
+    logger.info(f'Loading merged index from {index_path}')
+    flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mmap else 0
+    with stage('index_load'):
+        index = faiss.read_index(index_path, flags)
+    if hasattr(index, 'hnsw'):
+        index.hnsw.efSearch = efsearch
+    manifest = load_json(manifest_path(index_path))
+    assert manifest['ntotal'] == index.ntotal, f'{index_path} does not match its manifest'
+    return index, manifest
+
+
+def merged_index_exists(index_path):
+    return index_path is not None and os.path.exists(index_path) and os.path.exists(manifest_path(index_path))
+
+
+def build_compressed_shards(extension_dir, extensions, shard_name, nlist=1024, m=16, nbits=8, opq=False,
+                            memory_friendly=False, max_phi=MAX_PHI):
+    for extension in extensions:
+        vectors = load_extension_vectors(extension_dir, extension, memory_friendly, max_phi).cpu().numpy()
+        index = build_compressed_shard(vectors, nlist, m, nbits, opq)
+        path = extension_shard_path(extension_dir, extension, shard_name)
+        logger.info(f'Writing {extension} shard to {path}')
+        faiss.write_index(index, path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Build a faiss index holding PAQ plus a list of 2PAQ extensions, so retrieval "
+                                     "jobs can load it directly instead of adding the extensions on every run. "
+                                     "With --shard_name, builds a compressed IVF-PQ shard per extension instead")
+    parser.add_argument('--faiss_index_path', type=str, default="data/indices/multi_base_256_hnsw_sq8.faiss",
+                        help="Path to the base PAQ faiss index")
+    parser.add_argument('--qas_to_retrieve_from', type=str,
+                        default="data/paq/TQA_TRAIN_NQ_TRAIN_PAQ/tqa-train-nq-train-PAQ.jsonl",
+                        help="path to the QA-pairs of the base index in jsonl format")
+    parser.add_argument('--extension_dir', default='../data/2PAQ', type=str, help="path to the 2PAQ relations")
+    parser.add_argument('--extensions', nargs='+', required=True, type=str, help="which relations to include")
+    parser.add_argument('--output_path', type=str, help="Path to write the merged index to")
+    parser.add_argument('--shard_name', type=str, default=None,
+                        help="Build one IVF-PQ shard per extension, written to <extension>.<shard_name>.faiss")
+    parser.add_argument('--nlist', type=int, default=1024, help="Number of IVF lists of the shards")
+    parser.add_argument('--m', type=int, default=16, help="Number of PQ sub-quantizers of the shards")
+    parser.add_argument('--nbits', type=int, default=8, help="Bits per PQ sub-quantizer code of the shards")
+    parser.add_argument('--opq', action='store_true', help="Apply an OPQ rotation before product quantization")
+    parser.add_argument('--max_phi', type=float, default=MAX_PHI,
+                        help="Max vector norm the base hnsw index was built with")
+    parser.add_argument('--memory_friendly_parsing', action='store_true',
+                        help='Pass this to load files more slowly, but save memory')
+    parser.add_argument('-v', '--verbose', action="store_true")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    assert (args.output_path is None) != (args.shard_name is None), "Specify either an --output_path or --shard_name"
+
+    if args.shard_name is not None:
+        build_compressed_shards(args.extension_dir, args.extensions, args.shard_name, args.nlist, args.m, args.nbits,
+                                args.opq, args.memory_friendly_parsing, args.max_phi)
+    else:
+        index = faiss.read_index(args.faiss_index_path)
+        add_extensions(index, args.extension_dir, args.extensions, args.memory_friendly_parsing, args.max_phi)
+        write_merged_index(index, args.output_path, args.qas_to_retrieve_from, args.extension_dir, args.extensions,
+                           args.max_phi)
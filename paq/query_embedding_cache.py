@@ -0,0 +1,128 @@
+# On disk cache of question embeddings, so retrieval jobs over the same questions only embed them once
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+from paq.retrievers.embed import embed
+from utils.data import atomic_write, load_json
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PATTERN = re.compile(r'keys(\.\d+)?\.json$')
+# Per cache directory the (segment, row) of every question in the segments read so far, and the number of rows of
+# those segments. Segments are never modified once written, so only new segments have to be read.
+ROWS = {}
+SEGMENT_SIZES = {}
+
+
+def normalize_question(question):
+    return ' '.join(question.split())
+
+
+def _cache_directory(cache_dir, model_name_or_path, fp16):
+    key = hashlib.sha1(f'{os.path.abspath(model_name_or_path)}|fp16={fp16}'.encode()).hexdigest()[:16]
+    return f'{cache_dir}/{key}'
+
+
+def _embeddings_path(keys_path):
+    return re.sub(r'keys(\.\d+)?\.json$', r'embeddings\1.npy', keys_path)
+
+
+@contextmanager
+def _lock(directory):
+    """Exclusive lock on a cache directory, held by a single process at a time"""
+    with open(f'{directory}/lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _segments(directory):
+    """
+    The keys files of the cache segments in order. A segment is complete once its keys file exists, as
+    that is written after its embeddings.
+    """
+    return sorted(p for p in glob.glob(f'{directory}/keys*.json') if SEGMENT_PATTERN.search(p))
+
+
+def _load_rows(directory):
+    """The (segment, row) of every cached question"""
+    rows = ROWS.setdefault(directory, {})
+    for keys_path in _segments(directory):
+        if keys_path not in SEGMENT_SIZES:
+            keys = load_json(keys_path)
+            SEGMENT_SIZES[keys_path] = len(keys)
+            for row, key in enumerate(keys):
+                rows.setdefault(key, (keys_path, row))
+    return rows
+
+
+def _write_segment(directory, keys, embeddings):
+    keys_path = f'{directory}/keys.{len(_segments(directory)):06d}.json'
+    with atomic_write(_embeddings_path(keys_path)) as f:
+        np.save(f, embeddings)
+    with atomic_write(keys_path) as f:
+        f.write(json.dumps(keys).encode())
+
+
+def _gather(rows, questions):
+    """Read the embeddings of `questions` from memory-mapped segments, touching only their rows"""
+    by_segment = {}
+    for i, question in enumerate(questions):
+        keys_path, row = rows[question]
+        by_segment.setdefault(keys_path, ([], []))
+        by_segment[keys_path][0].append(i)
+        by_segment[keys_path][1].append(row)
+
+    embeddings = np.empty((0, 0), dtype=np.float16)
+    for keys_path, (positions, segment_rows) in by_segment.items():
+        segment = np.load(_embeddings_path(keys_path), mmap_mode='r')
+        if len(segment) != SEGMENT_SIZES[keys_path]:
+            raise ValueError(f'Inconsistent query embedding cache segment {keys_path}')
+        if len(embeddings) == 0:
+            embeddings = np.empty((len(questions), segment.shape[1]), dtype=segment.dtype)
+        embeddings[positions] = segment[segment_rows]
+    return embeddings
+
+
+def embed_with_cache(model, tokenizer, qas, cache_dir, model_name_or_path, bsz=128, fp16=False):
+    """
+    Embed the questions of `qas`, reusing embeddings cached for (model, fp16, question).
+    Embeddings are stored as float16 in append-only segments, `embeddings.<n>.npy` with the questions of its rows in
+    `keys.<n>.json`, which are memory-mapped so only the rows of `qas` are read.
+    """
+    directory = _cache_directory(cache_dir, model_name_or_path, fp16)
+    os.makedirs(directory, exist_ok=True)
+    rows = _load_rows(directory)
+
+    questions = [normalize_question(qa['question']) for qa in qas]
+    missing = {}
+    for question, qa in zip(questions, qas):
+        if question not in rows and question not in missing:
+            missing[question] = qa
+
+    logger.info(f'{len(questions) - len(missing)}/{len(questions)} query embeddings loaded from cache')
+    if len(missing) > 0:
+        new_embeddings = embed(model, tokenizer, list(missing.values()), bsz=bsz, fp16=fp16)
+        new_embeddings = new_embeddings.cpu().numpy().astype(np.float16)
+
+        # Concurrent jobs may have cached some of the same questions meanwhile, only append the others
+        with _lock(directory):
+            rows = _load_rows(directory)
+            new = [i for i, question in enumerate(missing) if question not in rows]
+            if len(new) > 0:
+                keys = list(missing)
+                _write_segment(directory, [keys[i] for i in new], new_embeddings[new])
+        rows = _load_rows(directory)
+
+    return torch.from_numpy(_gather(rows, questions))
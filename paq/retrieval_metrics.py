@@ -0,0 +1,67 @@
+# Per stage timings of a retrieval run, so slow stages can be found from a report instead of the logs
+import csv
+import json
+import logging
+import resource
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+STAGES = {}
+
+
+@contextmanager
+def stage(name, items=None):
+    """Time a block of code as (one call of) stage `name`, processing `items` items"""
+    t = time.time()
+    yield
+    record(name, time.time() - t, items)
+
+
+def record(name, seconds, items=None):
+    durations, n_items = STAGES.get(name, ([], 0))
+    durations.append(seconds)
+    STAGES[name] = (durations, n_items + (items or 0))
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # ru_maxrss is in KB on linux
+
+
+def report():
+    stages = []
+    for name, (durations, items) in STAGES.items():
+        total = float(np.sum(durations))
+        stages.append({
+            'stage': name,
+            'calls': len(durations),
+            'total_seconds': total,
+            'p50_seconds': float(np.percentile(durations, 50)),
+            'p95_seconds': float(np.percentile(durations, 95)),
+            'p99_seconds': float(np.percentile(durations, 99)),
+            'items': items,
+            'items_per_second': items / total if items and total > 0 else None,
+        })
+    return {'stages': stages, 'peak_rss_mb': peak_rss_mb()}
+
+
+def dump_report(path):
+    """Write the report as json, or as csv with one row per stage if `path` ends with .csv"""
+    run_report = report()
+    for s in run_report['stages']:
+        logger.info(f"{s['stage']}: {s['total_seconds']:.2f} seconds in {s['calls']} calls")
+    logger.info(f"Peak RSS: {run_report['peak_rss_mb']:.0f} MB")
+
+    if path.endswith('.csv'):
+        with open(path, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=['stage', 'calls', 'total_seconds', 'p50_seconds', 'p95_seconds',
+                                                   'p99_seconds', 'items', 'items_per_second', 'peak_rss_mb'])
+            writer.writeheader()
+            for s in run_report['stages']:
+                writer.writerow({**s, 'peak_rss_mb': run_report['peak_rss_mb']})
+    else:
+        with open(path, 'w') as f:
+            json.dump(run_report, f, indent=2)
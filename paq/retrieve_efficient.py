@@ -8,7 +8,9 @@
 # LICENSE file in the root directory of this source tree.
 import argparse
 import json
-from itertools import takewhile, repeat
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 
 import torch
 import logging
@@ -16,11 +18,15 @@ import time
 import faiss
 import numpy as np
 
-from paq.retrievers.build_index import augment_vectors
+from paq.retrievers.extension_index import MAX_PHI, add_extensions, extension_qas_path, load_extension_shard, \
+    load_merged_index, merged_index_exists, write_merged_index
 from paq.retrievers.retriever_utils import load_retriever
 from paq.paq_utils import load_jsonl, dump_jsonl, parse_vectors_from_directory
 from paq.retrievers.embed import embed
-from copy import deepcopy
+from paq.retrievers.query_embedding_cache import embed_with_cache
+from paq.retrievers.retrieval_metrics import dump_report, record, stage
+from utils.data import dump_compact_results, dump_json, iter_jsonl_chunks, load_json, load_jsonl_rows, \
+    load_line_offsets, line_count
 
 logger = logging.getLogger(__name__)
 
@@ -36,10 +42,10 @@ def get_output_format(qas_to_answer, qas_to_retrieve_from_path, top_indices, top
     for qa_ind, qa in enumerate(qas_to_answer):
         res = []
         for score_ind, ind in enumerate(top_indices[qa_ind]):
+            if ind < 0:  # shard returned fewer than top_k results
+                continue
             score = top_scores[qa_ind][score_ind]
-            ret_qa = deepcopy(qas_to_retrieve_from[ind])
-            ret_qa['score'] = float(score)
-            res.append(ret_qa)
+            res.append({**qas_to_retrieve_from[ind], 'score': float(score)})
         results.append(res)
 
     return [{'input_qa': in_qa, 'retrieved_qas': ret_qas} for in_qa, ret_qas in zip(qas_to_answer, results)]
@@ -50,6 +56,40 @@ def _torch_mips(index, query_batch, top_k):
     return sims.topk(top_k)
 
 
+def _partial_topk(scores, indices, top_k):
+    if scores.shape[1] <= top_k:
+        return scores, indices
+    best = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    return np.take_along_axis(scores, best, axis=1), np.take_along_axis(indices, best, axis=1)
+
+
+def _search_blocks(vectors, queries, top_k, block_starts, block_size):
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+    best_indices = np.empty((len(queries), 0), dtype=np.int64)
+    for start in block_starts:
+        sims = queries @ vectors[start:start + block_size].T
+        indices = np.broadcast_to(np.arange(start, start + sims.shape[1]), sims.shape)
+        scores, indices = _partial_topk(sims, indices, top_k)
+        best_scores, best_indices = _partial_topk(np.concatenate([best_scores, scores], axis=1),
+                                                  np.concatenate([best_indices, indices], axis=1), top_k)
+    return best_scores, best_indices
+
+
+def _blocked_mips(index, query_batch, top_k, block_size=4096, n_threads=None):
+    """
+    Exact MIPS on cpu. The index is scanned in blocks of `block_size` vectors spread over a thread pool, each thread
+    keeping a running top k per query, so the similarity matrix never exceeds (batch size, block_size).
+    """
+    vectors = index.numpy()
+    queries = query_batch.numpy()
+    n_threads = n_threads or os.cpu_count()
+    block_starts = list(range(0, len(vectors), block_size))
+    with ThreadPoolExecutor(n_threads) as executor:
+        results = list(executor.map(lambda starts: _search_blocks(vectors, queries, top_k, starts, block_size),
+                                    [block_starts[i::n_threads] for i in range(n_threads)]))
+    return merge_topk([r[0] for r in results], [r[1] for r in results], top_k, larger_is_better=True)
+
+
 def _flat_index_mips(index, query_batch, top_k):
     return index.search(query_batch.numpy(), top_k)
 
@@ -63,98 +103,283 @@ def _aux_dim_index_mips(index, query_batch, top_k):
 
 def _get_mips_function(index):
     if type(index) == torch.Tensor:
-        return _torch_mips
-    elif 'hnsw' in str(type(index)).lower():
+        return _torch_mips if index.is_cuda else _blocked_mips
+    elif 'hnsw' in str(type(index)).lower() or index.metric_type == faiss.METRIC_L2:
         return _aux_dim_index_mips
     else:
         return _flat_index_mips
 
 
-def mips(index, queries, top_k, n_queries_to_parallelize=256):
-    t = time.time()
-    all_top_indices = None
-    all_top_scores = None
+def _index_size(index):
+    return index.shape[0] if type(index) == torch.Tensor else index.ntotal
+
+
+def _larger_is_better(index):
+    return type(index) == torch.Tensor or index.metric_type == faiss.METRIC_INNER_PRODUCT
+
+
+def _to_numpy(x):
+    return x.cpu().numpy() if type(x) == torch.Tensor else np.asarray(x)
+
+
+def _search_shard(shard, offset, query_batch, top_k):
+    scores, top_indices = _get_mips_function(shard)(shard, query_batch, min(top_k, _index_size(shard)))
+    top_indices = _to_numpy(top_indices)
+    return _to_numpy(scores), np.where(top_indices >= 0, top_indices + offset, -1)
 
-    _mips = _get_mips_function(index)
 
-    for mb in range(0, len(queries), n_queries_to_parallelize):
-        query_batch = queries[mb:mb + n_queries_to_parallelize].float()
-        scores, top_indices = _mips(index, query_batch, top_k)
+def merge_topk(shard_scores, shard_indices, top_k, larger_is_better):
+    """Merge the top k of every shard into an overall top k, missing results (index -1) are ranked last"""
+    scores = np.concatenate(shard_scores, axis=1)
+    indices = np.concatenate(shard_indices, axis=1)
+    worst = -np.inf if larger_is_better else np.inf
+    scores = np.where(indices >= 0, scores, worst)
+    order = np.argsort(-scores if larger_is_better else scores, axis=1, kind='stable')[:, :top_k]
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(indices, order, axis=1)
 
-        all_top_indices = top_indices if all_top_indices is None else np.concatenate([all_top_indices, top_indices])
-        all_top_scores = scores if all_top_scores is None else np.concatenate([all_top_scores, scores])
 
-        delta = time.time() - t
-        logger.info(
-            f'{len(all_top_indices)}/ {len(queries)} queries searched in {delta:04f} '
-            f'seconds ({len(all_top_indices) / delta} per second)')
+def _result_buffer(shape, dtype, fill_value, path=None):
+    if path is None:
+        return np.full(shape, fill_value, dtype=dtype)
+    buffer = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+    buffer[:] = fill_value
+    return buffer
 
-    assert len(all_top_indices) == len(queries)
+
+def mips(index, queries, top_k, n_queries_to_parallelize=256, n_threads=None, memmap_prefix=None,
+         base_results=None):
+    """
+    Search an index, or a list of index shards whose rows are numbered consecutively in list order.
+    Shards are searched concurrently and their results merged by score.
+    Results are written into preallocated (n_queries, top_k) arrays, these are memory mapped `.npy` files
+    `<memmap_prefix>.top_indices.npy` and `<memmap_prefix>.top_scores.npy` if a memmap_prefix is given.
+    `base_results` are the (top_indices, top_scores) of an earlier search on the first shard, which is then
+    not searched again.
+    """
+    t = time.time()
+
+    shards = index if isinstance(index, list) else [index]
+    offsets = np.cumsum([0] + [_index_size(shard) for shard in shards[:-1]])
+    larger_is_better = _larger_is_better(shards[0])
+    assert all(_larger_is_better(shard) == larger_is_better for shard in shards), 'Shards use different metrics'
+
+    shape = (len(queries), top_k)
+    all_top_indices = _result_buffer(shape, np.int64, -1,
+                                     None if memmap_prefix is None else f'{memmap_prefix}.top_indices.npy')
+    all_top_scores = _result_buffer(shape, np.float32, -np.inf if larger_is_better else np.inf,
+                                    None if memmap_prefix is None else f'{memmap_prefix}.top_scores.npy')
+
+    with ThreadPoolExecutor(n_threads or len(shards)) as executor:
+        for mb in range(0, len(queries), n_queries_to_parallelize):
+            query_batch = queries[mb:mb + n_queries_to_parallelize].float()
+            t_batch = time.time()
+            if base_results is None:
+                results = list(executor.map(_search_shard, shards, offsets, repeat(query_batch), repeat(top_k)))
+            else:
+                batch = slice(mb, mb + len(query_batch))
+                results = [(base_results[1][batch], base_results[0][batch])] + list(
+                    executor.map(_search_shard, shards[1:], offsets[1:], repeat(query_batch), repeat(top_k)))
+            if len(results) == 1:
+                scores, top_indices = results[0]
+            else:
+                scores, top_indices = merge_topk([r[0] for r in results], [r[1] for r in results], top_k,
+                                                 larger_is_better)
+            record('search_batch', time.time() - t_batch, len(query_batch))
+
+            n_searched = mb + len(query_batch)
+            all_top_indices[mb:n_searched, :top_indices.shape[1]] = top_indices
+            all_top_scores[mb:n_searched, :scores.shape[1]] = scores
+
+            delta = time.time() - t
+            logger.info(
+                f'{n_searched}/ {len(queries)} queries searched in {delta:04f} '
+                f'seconds ({n_searched / delta} per second)')
+
+    if memmap_prefix is not None:
+        all_top_indices.flush()
+        all_top_scores.flush()
 
     delta = time.time() - t
     logger.info(f'Index searched in {delta:04f} seconds ({len(queries) / delta} per second)')
     return all_top_indices, all_top_scores
 
 
-def run_queries(model, tokenizer, qas_to_retrieve_from, qas_to_answer, top_k, index=None,
-                batch_size=128, fp16=False, n_queries_to_parallelize=2048):
+def embed_queries(model, tokenizer, qas_to_answer, batch_size=128, fp16=False, embedding_cache_dir=None,
+                  model_name_or_path=None):
+    logger.info('Embedding QAs to answer:')
+    with stage('query_embedding', len(qas_to_answer)):
+        if embedding_cache_dir is None:
+            return embed(model, tokenizer, qas_to_answer, bsz=batch_size, fp16=fp16)
+        return embed_with_cache(model, tokenizer, qas_to_answer, embedding_cache_dir, model_name_or_path,
+                                bsz=batch_size, fp16=fp16)
+
+
+def search_queries(model, tokenizer, qas_to_retrieve_from, qas_to_answer, top_k, index=None,
+                   batch_size=128, fp16=False, n_queries_to_parallelize=2048, n_search_threads=None,
+                   results_memmap_prefix=None, embedding_cache_dir=None, model_name_or_path=None):
     if index is None:
         index = embed(model, tokenizer, qas_to_retrieve_from, bsz=batch_size, fp16=fp16).float()
 
-    logger.info('Embedding QAs to answer:')
-    embedded_qas_to_answer = embed(model, tokenizer, qas_to_answer, bsz=batch_size, fp16=fp16)
+    embedded_qas_to_answer = embed_queries(model, tokenizer, qas_to_answer, batch_size, fp16, embedding_cache_dir,
+                                           model_name_or_path)
     logger.info('Running MIPS search:')
-    top_indices, top_scores = mips(index, embedded_qas_to_answer, top_k,
-                                   n_queries_to_parallelize=n_queries_to_parallelize)
+    return mips(index, embedded_qas_to_answer, top_k, n_queries_to_parallelize=n_queries_to_parallelize,
+                n_threads=n_search_threads, memmap_prefix=results_memmap_prefix)
+
 
+def run_queries(model, tokenizer, qas_to_retrieve_from, qas_to_answer, top_k, index=None,
+                batch_size=128, fp16=False, n_queries_to_parallelize=2048, n_search_threads=None,
+                results_memmap_prefix=None, embedding_cache_dir=None, model_name_or_path=None):
+    top_indices, top_scores = search_queries(model, tokenizer, qas_to_retrieve_from, qas_to_answer, top_k, index,
+                                             batch_size, fp16, n_queries_to_parallelize, n_search_threads,
+                                             results_memmap_prefix, embedding_cache_dir, model_name_or_path)
     return get_output_format(qas_to_answer, qas_to_retrieve_from, top_indices, top_scores)
 
 
+def write_results(output_file, output_format, qas_to_answer, qas_to_answer_path, qas_to_retrieve_from_paths,
+                  top_indices, top_scores):
+    if output_format == 'compact':
+        with stage('output_write', len(top_indices)):
+            dump_compact_results(output_file, top_indices, top_scores, qas_to_retrieve_from_paths,
+                                 qas_to_answer_path)
+    else:
+        results = get_output_format(qas_to_answer, qas_to_retrieve_from_paths, top_indices, top_scores)
+        with stage('output_write', len(results)):
+            dump_jsonl(results, output_file)
+
+
+def _dump_progress(progress, progress_path):
+    dump_json(progress, f'{progress_path}.tmp')
+    os.replace(f'{progress_path}.tmp', progress_path)
+
+
+def run_streaming(model, tokenizer, qas_to_retrieve_from, qas_to_answer_path, top_k, index, output_file,
+                  output_format='jsonl', chunk_size=8192, batch_size=128, fp16=False, n_queries_to_parallelize=2048,
+                  n_search_threads=None, embedding_cache_dir=None, model_name_or_path=None):
+    """
+    Embed, search and write the questions to answer one chunk at a time, so memory use does not grow with the
+    number of questions. Progress is recorded in `<output_file>.progress.json` after every chunk and an
+    interrupted run continues after the last completed chunk.
+    """
+    progress_path = f'{output_file}.progress.json'
+    progress = load_json(progress_path) if os.path.exists(progress_path) else {'queries_done': 0, 'output_bytes': 0}
+    resume = progress['queries_done'] > 0
+    if resume:
+        logger.info(f"Resuming after {progress['queries_done']} queries")
+
+    if output_format == 'compact':
+        shape = (len(load_line_offsets(qas_to_answer_path)), top_k)
+        mode = 'r+' if resume else 'w+'
+        all_top_indices = np.lib.format.open_memmap(f'{output_file}.top_indices.npy', mode=mode, dtype=np.int64,
+                                                    shape=shape)
+        all_top_scores = np.lib.format.open_memmap(f'{output_file}.top_scores.npy', mode=mode, dtype=np.float32,
+                                                   shape=shape)
+    else:
+        writer = open(output_file, 'r+b' if resume else 'wb')
+        writer.truncate(progress['output_bytes'])  # drop output of a chunk that was interrupted
+        writer.seek(progress['output_bytes'])
+
+    for qas_to_answer in iter_jsonl_chunks(qas_to_answer_path, chunk_size, start=progress['queries_done']):
+        start = progress['queries_done']
+        end = start + len(qas_to_answer)
+        top_indices, top_scores = search_queries(model, tokenizer, qas_to_retrieve_from, qas_to_answer, top_k, index,
+                                                 batch_size, fp16, n_queries_to_parallelize, n_search_threads,
+                                                 embedding_cache_dir=embedding_cache_dir,
+                                                 model_name_or_path=model_name_or_path)
+
+        if output_format == 'compact':
+            with stage('output_write', len(qas_to_answer)):
+                all_top_indices[start:end] = top_indices
+                all_top_scores[start:end] = top_scores
+                all_top_indices.flush()
+                all_top_scores.flush()
+        else:
+            results = get_output_format(qas_to_answer, qas_to_retrieve_from, top_indices, top_scores)
+            with stage('output_write', len(results)):
+                for result in results:
+                    writer.write((json.dumps(result) + '\n').encode())
+                writer.flush()
+                os.fsync(writer.fileno())
+            progress['output_bytes'] = writer.tell()
+
+        progress['queries_done'] = end
+        _dump_progress(progress, progress_path)
+        logger.info(f'{end} queries answered')
+
+    if output_format == 'compact':
+        dump_compact_results(output_file, all_top_indices, all_top_scores, qas_to_retrieve_from, qas_to_answer_path)
+        del all_top_indices, all_top_scores
+        os.remove(f'{output_file}.top_indices.npy')
+        os.remove(f'{output_file}.top_scores.npy')
+    else:
+        writer.close()
+    os.remove(progress_path)
+
+
+def run_sweep(model, tokenizer, qas_to_retrieve_from, qas_to_answer, top_k, index, extension_dir, extensions,
+              output_dir, batch_size=128, fp16=False, n_queries_to_parallelize=2048, embedding_cache_dir=None,
+              model_name_or_path=None, memory_friendly=False, max_phi=MAX_PHI, output_format='jsonl',
+              qas_to_answer_path=None, shard_name=None, nprobe=16):
+    """
+    Retrieve with the base index extended by each extension in turn, writing `<output_dir>/<extension>.jsonl`
+    (or `.npz` for the compact output format).
+    The questions are embedded and the base index searched only once, the top k of each extension shard is
+    merged into the base results. Extensions with an existing output file are skipped.
+    """
+    embedded_qas_to_answer = embed_queries(model, tokenizer, qas_to_answer, batch_size, fp16, embedding_cache_dir,
+                                           model_name_or_path)
+    logger.info('Running MIPS search on the base index:')
+    base_top_indices, base_top_scores = mips(index, embedded_qas_to_answer, top_k,
+                                             n_queries_to_parallelize=n_queries_to_parallelize)
+
+    for extension in extensions:
+        output_file = f'{output_dir}/{extension}.{"npz" if output_format == "compact" else "jsonl"}'
+        if os.path.exists(output_file):
+            logger.info(f'Skipping {extension}, {output_file} exists')
+            continue
+
+        logger.info(f'Running MIPS search on {extension}:')
+        shard = load_extension_shard(extension_dir, extension, index, memory_friendly, max_phi, shard_name, nprobe)
+        top_indices, top_scores = mips([index, shard], embedded_qas_to_answer, top_k,
+                                       n_queries_to_parallelize=n_queries_to_parallelize, n_threads=1,
+                                       base_results=(base_top_indices, base_top_scores))
+        del shard
+
+        qas_to_retrieve_from_paths = [qas_to_retrieve_from, extension_qas_path(extension_dir, extension)]
+        write_results(output_file, output_format, qas_to_answer, qas_to_answer_path, qas_to_retrieve_from_paths,
+                      top_indices, top_scores)
+
+
 def _load_index_if_exists(faiss_index_path, precomputed_embeddings_dir, n_vectors_to_load=None, memory_friendly=False,
                           efsearch=128):
     index = None
     if faiss_index_path is not None:
         assert precomputed_embeddings_dir is None, "Do not specify both a --faiss_index_path and --precomputed_embeddings_dir"
         logger.info('Loading Faiss index:')
-        index = faiss.read_index(faiss_index_path)
+        with stage('index_load'):
+            index = faiss.read_index(faiss_index_path)
         if hasattr(index, 'hnsw'):
             index.hnsw.efSearch = efsearch
 
     elif precomputed_embeddings_dir is not None:
         logger.info('Loading vectors index from file:')
-        index = parse_vectors_from_directory(
-            precomputed_embeddings_dir,
-            memory_friendly=memory_friendly,
-            size=n_vectors_to_load
-        ).float()
+        with stage('index_load'):
+            index = parse_vectors_from_directory(
+                precomputed_embeddings_dir,
+                memory_friendly=memory_friendly,
+                size=n_vectors_to_load
+            ).float()
 
     logger.info('Index loaded') if index is not None else None
     return index
 
-def line_count(filename):
-    f = open(filename, 'rb')
-    bufgen = takewhile(lambda x: x, (f.raw.read(1024*1024) for _ in repeat(None)))
-    return sum( buf.count(b'\n') for buf in bufgen )
-
-
 def load_jsonl_subset(files, indices):
     logging.info(f'Loading {files}')
 
-    indices = sorted(list(set(indices)))
-    pointer = 0
-    results = {}
-    ln = 0
-    for fi in files:
-        for line in open(fi):
-            if ln == indices[pointer]:
-                results[ln] = json.loads(line)
-                if len(results) == len(indices):
-                    break
-                else:
-                    pointer += 1
-            ln += 1
-
-    logging.info(f'Loaded {len(indices)} Items from {files}')
+    with stage('jsonl_subset_resolution', len(indices)):
+        results = load_jsonl_rows(files, indices)
+
+    logging.info(f'Loaded {len(results)} Items from {files}')
     return results
 
 
@@ -174,7 +399,10 @@ if __name__ == '__main__':
                         default="data/paq/TQA_TRAIN_NQ_TRAIN_PAQ/tqa-train-nq-train-PAQ.jsonl",
                         help="path to QA-pairs to retrieve answers from in jsonl format")
     parser.add_argument('--top_k', type=int, default=50, help="top K QA-pairs to retrieve for each input question")
-    parser.add_argument('--output_file', type=str, required=True, help='Path to write jsonl results to')
+    parser.add_argument('--output_file', type=str, help='Path to write jsonl results to')
+    parser.add_argument('--output_format', type=str, default='jsonl', choices=['jsonl', 'compact'],
+                        help="jsonl writes the retrieved QA-pairs, compact writes their corpus rows and scores "
+                             "as numpy columns to a .npz file (see utils.data.load_compact_results)")
     parser.add_argument('--faiss_index_path', type=str, help="Path to faiss index, if retrieving from a faiss index",
                         default="data/indices/multi_base_256_hnsw_sq8.faiss")
     parser.add_argument('--precomputed_embeddings_dir', default=None, type=str,
@@ -190,8 +418,45 @@ if __name__ == '__main__':
     parser.add_argument('--extension_dir', default='../data/2PAQ', type=str,
                         help="path to a directory of vector embeddings if retrieving from raw embeddign vectors")
     parser.add_argument('--extensions', nargs='+', default=[], type=str, help="which relations to include")
+    parser.add_argument('--max_phi', type=float, default=MAX_PHI,
+                        help="Max vector norm the base hnsw index was built with, used to augment extension vectors")
+    parser.add_argument('--merged_index_path', type=str, default=None,
+                        help="Path to an index holding the base index plus --extensions. It is loaded if it exists, "
+                             "otherwise it is written after adding the extensions so later runs can reuse it")
+    parser.add_argument('--shard_extensions', action='store_true',
+                        help="Search every extension as a separate index shard instead of adding it to the base index")
+    parser.add_argument('--extension_shard_name', type=str, default=None,
+                        help="Load prebuilt extension shards <extension>.<name>.faiss (see extension_index.py) "
+                             "instead of building flat shards")
+    parser.add_argument('--faiss_nprobe', type=int, default=16,
+                        help="Number of IVF lists to probe when searching IVF-PQ extension shards")
+    parser.add_argument('--n_search_threads', type=int, default=None,
+                        help="Threads to search index shards with, defaults to one per shard")
+    parser.add_argument('--results_memmap_prefix', type=str, default=None,
+                        help="Write the raw top k indices and scores to memory mapped .npy files with this prefix "
+                             "instead of keeping them in memory")
+    parser.add_argument('--query_embedding_cache_dir', type=str, default=None,
+                        help="Directory to cache question embeddings in, so later runs skip embedding them")
+    parser.add_argument('--sweep_extensions', nargs='+', default=[], type=str,
+                        help="Retrieve with the base index extended by each of these relations in turn, loading the "
+                             "index and model only once. Writes one jsonl per relation to --sweep_output_dir")
+    parser.add_argument('--stream_chunk_size', type=int, default=None,
+                        help="Answer the questions in chunks of this size, writing results after every chunk. "
+                             "Keeps memory use constant and resumes after the last written chunk if interrupted")
+    parser.add_argument('--metrics_file', type=str, default=None,
+                        help="Write per stage timings and peak memory of the run to this .json or .csv file")
+    parser.add_argument('--sweep_output_dir', type=str, default='../data/results',
+                        help='Directory to write the jsonl results of --sweep_extensions to')
 
     args = parser.parse_args()
+    assert not (args.shard_extensions and args.merged_index_path), \
+        "Do not specify both --shard_extensions and --merged_index_path"
+    assert (args.output_file is None) == bool(args.sweep_extensions), \
+        "Specify either an --output_file or --sweep_extensions"
+    assert not (args.sweep_extensions and (args.extensions or args.merged_index_path)), \
+        "--sweep_extensions searches the base index only, do not combine it with --extensions or --merged_index_path"
+    assert not (args.sweep_extensions and args.stream_chunk_size), \
+        "Do not specify both --sweep_extensions and --stream_chunk_size"
 
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
@@ -199,43 +464,102 @@ if __name__ == '__main__':
 
     model, tokenizer = load_retriever(args.model_name_or_path)
 
-    qas_to_answer = load_jsonl(args.qas_to_answer, memory_friendly=args.memory_friendly_parsing)
+    if args.stream_chunk_size is None:
+        qas_to_answer = load_jsonl(args.qas_to_answer, memory_friendly=args.memory_friendly_parsing)
     # qas_to_retrieve_from = load_jsonl(args.qas_to_retrieve_from, memory_friendly=args.memory_friendly_parsing)
     qas_to_retrieve_from_paths = [args.qas_to_retrieve_from]
 
-    n_vectors_to_load = line_count(args.qas_to_retrieve_from)
-
-    base_index = _load_index_if_exists(
-        args.faiss_index_path,
-        args.precomputed_embeddings_dir,
-        n_vectors_to_load=n_vectors_to_load,
-        memory_friendly=args.memory_friendly_parsing,
-        efsearch=args.faiss_efsearch
-    )
+    if merged_index_exists(args.merged_index_path):
+        base_index, manifest = load_merged_index(args.merged_index_path, efsearch=args.faiss_efsearch)
+        assert manifest['extensions'] == args.extensions, \
+            f"{args.merged_index_path} holds extensions {manifest['extensions']}, not {args.extensions}"
+        qas_to_retrieve_from_paths = manifest['qas_to_retrieve_from_paths']
+    else:
+        with stage('corpus_line_count'):
+            n_vectors_to_load = line_count(args.qas_to_retrieve_from)
 
-    for extension in args.extensions:
-        print(extension)
-        logger.info('Loading vectors index from file:')
-        vectors = parse_vectors_from_directory(
-            f'{args.extension_dir}/{extension}/vectors',
+        base_index = _load_index_if_exists(
+            args.faiss_index_path,
+            args.precomputed_embeddings_dir,
+            n_vectors_to_load=n_vectors_to_load,
             memory_friendly=args.memory_friendly_parsing,
-        ).float()
-        max_phi = 42.0015
-        vectors = augment_vectors(vectors, max_phi=max_phi)
-        qas_to_retrieve_from_paths.append(f'{args.extension_dir}/{extension}/{extension}.jsonl')
-        base_index.add(vectors.cpu().numpy())
-
-    model, tokenizer = load_retriever(args.model_name_or_path)
-
-    retrieved_answers = run_queries(
-        model,
-        tokenizer,
-        qas_to_retrieve_from_paths,
-        qas_to_answer,
-        args.top_k,
-        base_index,
-        args.batch_size,
-        args.fp16,
-        args.n_queries_to_parallelize,
-    )
-    dump_jsonl(retrieved_answers, args.output_file)
+            efsearch=args.faiss_efsearch
+        )
+
+        if args.shard_extensions:
+            base_index = [base_index] + [
+                load_extension_shard(args.extension_dir, extension, base_index, args.memory_friendly_parsing,
+                                     args.max_phi, args.extension_shard_name, args.faiss_nprobe)
+                for extension in args.extensions
+            ]
+        else:
+            add_extensions(base_index, args.extension_dir, args.extensions, args.memory_friendly_parsing,
+                           args.max_phi)
+        qas_to_retrieve_from_paths += [extension_qas_path(args.extension_dir, e) for e in args.extensions]
+
+        if args.merged_index_path is not None:
+            write_merged_index(base_index, args.merged_index_path, args.qas_to_retrieve_from, args.extension_dir,
+                               args.extensions, args.max_phi)
+
+    if args.sweep_extensions:
+        run_sweep(
+            model,
+            tokenizer,
+            args.qas_to_retrieve_from,
+            qas_to_answer,
+            args.top_k,
+            base_index,
+            args.extension_dir,
+            args.sweep_extensions,
+            args.sweep_output_dir,
+            args.batch_size,
+            args.fp16,
+            args.n_queries_to_parallelize,
+            args.query_embedding_cache_dir,
+            args.model_name_or_path,
+            args.memory_friendly_parsing,
+            args.max_phi,
+            args.output_format,
+            args.qas_to_answer,
+            args.extension_shard_name,
+            args.faiss_nprobe,
+        )
+    elif args.stream_chunk_size is not None:
+        run_streaming(
+            model,
+            tokenizer,
+            qas_to_retrieve_from_paths,
+            args.qas_to_answer,
+            args.top_k,
+            base_index,
+            args.output_file,
+            args.output_format,
+            args.stream_chunk_size,
+            args.batch_size,
+            args.fp16,
+            args.n_queries_to_parallelize,
+            args.n_search_threads,
+            args.query_embedding_cache_dir,
+            args.model_name_or_path,
+        )
+    else:
+        top_indices, top_scores = search_queries(
+            model,
+            tokenizer,
+            qas_to_retrieve_from_paths,
+            qas_to_answer,
+            args.top_k,
+            base_index,
+            args.batch_size,
+            args.fp16,
+            args.n_queries_to_parallelize,
+            args.n_search_threads,
+            args.results_memmap_prefix,
+            args.query_embedding_cache_dir,
+            args.model_name_or_path,
+        )
+        write_results(args.output_file, args.output_format, qas_to_answer, args.qas_to_answer,
+                      qas_to_retrieve_from_paths, top_indices, top_scores)
+
+    if args.metrics_file is not None:
+        dump_report(args.metrics_file)
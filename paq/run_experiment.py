@@ -67,6 +67,8 @@ def get_retrieval_command(relation):
            '--verbose ' \
            '--faiss_index_path ./data/indices/multi_base_256_hnsw_sq8.faiss ' \
            f'--output_file ../data/results/{relation}.jsonl ' \
+           f'--metrics_file ../data/logs/retrieve.{relation}.metrics.json ' \
+           '--query_embedding_cache_dir ../data/cache/query_embeddings ' \
            '--extension_dir ../data/2PAQ ' \
            f'--extensions {relation}'
 
@@ -88,6 +90,58 @@ def generate_retrieval_job(relations):
 conda activate paq
 export LANG="en_US.utf8"
 export LANGUAGE="en_US:en"
+export PYTHONPATH="{home}:$PYTHONPATH"
+
+cd {home}/paq
+
+"""
+
+    body_lines = []
+
+    for job_id, command_line in enumerate(command_lines, 1):
+        body_lines.append(f'test $SGE_TASK_ID -eq {job_id} && sleep 10 && {command_line}')
+
+    file = header + "\n".join(body_lines)
+    return file
+
+
+def get_sweep_retrieval_command(relations):
+    return 'python -m paq.retrievers.retrieve_efficient ' \
+           '--model_name_or_path ./data/models/retrievers/retriever_multi_base_256 ' \
+           '--qas_to_answer ../data/annotated_datasets/datasets.augmented.jsonl ' \
+           '--qas_to_retrieve_from ./data/paq/TQA_TRAIN_NQ_TRAIN_PAQ/tqa-train-nq-train-PAQ.jsonl ' \
+           '--top_k 50 ' \
+           '--fp16 ' \
+           '--memory_friendly_parsing ' \
+           '--verbose ' \
+           '--faiss_index_path ./data/indices/multi_base_256_hnsw_sq8.faiss ' \
+           '--query_embedding_cache_dir ../data/cache/query_embeddings ' \
+           '--extension_dir ../data/2PAQ ' \
+           '--sweep_output_dir ../data/results ' \
+           f'--metrics_file ../data/logs/retrieve.{relations[0]}.metrics.json ' \
+           f'--sweep_extensions {" ".join(relations)}'
+
+
+def generate_sweep_retrieval_job(relations, relations_per_task=10):
+    """Retrieve for groups of relations per task, loading the index and model once per group"""
+    groups = [relations[i:i + relations_per_task] for i in range(0, len(relations), relations_per_task)]
+    command_lines = [get_sweep_retrieval_command(g) for g in groups]
+
+    header = f"""
+#$ -cwd
+#$ -S /bin/bash
+#$ -o {home}/data/logs/retrieve.out
+#$ -e {home}/data/logs/retrieve.err
+#$ -t 1-{len(command_lines)}
+#$ -l tmem=40G
+#$ -l h_rt=4:00:00
+#$ -l gpu=true
+#$ -N paq-retrieve
+
+conda activate paq
+export LANG="en_US.utf8"
+export LANGUAGE="en_US:en"
+export PYTHONPATH="{home}:$PYTHONPATH"
 
 cd {home}/paq
 
@@ -177,7 +231,7 @@ with open("embed.job.sh", "w") as file:
 
 relations_to_retrieve = filter(get_to_retrieve_relations())
 with open("retrieve.job.sh", "w") as file:
-    file.write(generate_retrieval_job(relations_to_retrieve))
+    file.write(generate_sweep_retrieval_job(relations_to_retrieve))
 
 relations_to_rerank = get_to_rerank_relations()
 with open("rerank.job.sh", "w") as file:
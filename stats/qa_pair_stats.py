@@ -1,14 +1,10 @@
 import glob
-import subprocess
-from utils.cache import cache
+from utils.data import line_count
 
 
-@cache('get_qa_pairs_count')
 def get_qa_pairs_count(relation):
     path = f'../data/2PAQ/{relation}/{relation}.jsonl'
-    result = subprocess.check_output(['wc', '-l', path])
-    count = float(str(result).replace("b'", '').split(' ')[0])
-    return count
+    return line_count(path)
 
 
 def get_relations():
@@ -0,0 +1,101 @@
+from utils.cache import LRUCache, cache, file_hash, file_stat, memoize
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.info()['hits'] == 3 and cache.info()['misses'] == 1
+
+
+def test_lru_cache_max_bytes():
+    cache = LRUCache(maxsize=None, max_bytes=1000)
+    for i in range(100):
+        cache.set(i, 'x' * 100)
+    assert 0 < len(cache.data) < 10
+    assert cache.bytes <= 1000
+
+
+def test_memoize_key():
+    calls = []
+
+    @memoize(maxsize=10, key=lambda text, question: (text, question.startswith('how many')))
+    def count(text, question):
+        calls.append(text)
+        return len(text)
+
+    assert count('abc', 'how many a') == 3
+    assert count('abc', 'how many b') == 3
+    assert count('abc', 'who') == 3
+    assert calls == ['abc', 'abc']
+    assert count.cache_info()['hits'] == 1
+
+
+def test_cache_depends_on(tmp_path):
+    path = tmp_path / 'input.txt'
+    path.write_text('a')
+
+    @cache('read', directory=str(tmp_path / 'cache'), depends_on=lambda p: file_stat(p))
+    def read(p):
+        with open(p) as f:
+            return f.read()
+
+    assert read(str(path)) == 'a'
+    assert read(str(path)) == 'a'
+    path.write_text('bb')
+    assert read(str(path)) == 'bb'
+    assert read.cache_info()['hits'] == 1 and read.cache_info()['misses'] == 2
+    read.cache_close()
+
+
+def test_cache_eviction_policy(tmp_path):
+    @cache('square', directory=str(tmp_path), size_limit=2 ** 20, eviction_policy='least-recently-used')
+    def square(x):
+        return x * x
+
+    assert square(3) == 9
+    assert square.cache.size_limit == 2 ** 20
+    assert square.cache.eviction_policy == 'least-recently-used'
+    square.cache_close()
+
+
+def test_file_hash(tmp_path):
+    path = tmp_path / 'input.txt'
+    path.write_text('a')
+    first = file_hash(str(path))
+    path.write_text('a')
+    assert file_hash(str(path)) == first
+    path.write_text('b')
+    assert file_hash(str(path)) != first
+
+
+def test_lru_cache_ttl(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr('utils.cache.time.monotonic', lambda: now[0])
+    cache = LRUCache(maxsize=10, ttl=5)
+    cache.set('a', 1)
+    now[0] = 4
+    assert cache.get('a') == 1
+    now[0] = 6
+    assert cache.get('a') is None
+    assert len(cache.data) == 0 and cache.bytes == 0
+
+
+def test_cache_memory_tier(tmp_path):
+    calls = []
+
+    @cache('double', directory=str(tmp_path), memory_maxsize=2)
+    def double(x):
+        calls.append(x)
+        return 2 * x
+
+    assert double(1) == 2 and double(1) == 2
+    assert double.cache_info()['memory']['hits'] == 1
+    double.set_many({(2,): 4, (3,): 6})
+    assert double.get_many([(1,), (2,), (3,), (4,)]) == {(1,): 2, (2,): 4, (3,): 6}
+    assert double(3) == 6 and calls == [1]
+    double.cache_close()
@@ -0,0 +1,106 @@
+import json
+import multiprocessing
+import os
+
+from utils.data import dump_compact_results, iter_jsonl_chunks, line_count, load_jsonl_rows, load_line_offsets, \
+    load_retrieval_results, open_jsonl, load_jsonl
+
+
+def write_jsonl(path, items):
+    with open(path, 'w') as f:
+        for item in items:
+            f.write(json.dumps(item) + '\n')
+
+
+def test_load_jsonl_rows(tmp_path):
+    first = tmp_path / 'first.jsonl'
+    second = tmp_path / 'second.jsonl'
+    write_jsonl(first, [{'question': f'q{i}'} for i in range(5)])
+    write_jsonl(second, [{'question': f'q{i}'} for i in range(5, 8)])
+
+    rows = load_jsonl_rows([str(first), str(second)], [7, 0, 4, 5, 4])
+    assert sorted(rows) == [0, 4, 5, 7]
+    assert all(rows[i]['question'] == f'q{i}' for i in rows)
+
+
+def _load_last_row(path, n, barrier, results):
+    barrier.wait()
+    results.put(load_jsonl_rows([path], [n - 1])[n - 1]['question'])
+
+
+def test_load_line_offsets_concurrent_builds(tmp_path):
+    path = str(tmp_path / 'qas.jsonl')
+    n = 200000
+    write_jsonl(path, [{'question': f'q{i}'} for i in range(n)])
+    context = multiprocessing.get_context('fork')
+    for _ in range(3):
+        if os.path.exists(f'{path}.offsets.npy'):
+            os.remove(f'{path}.offsets.npy')
+        barrier, results = context.Barrier(4), context.Queue()
+        processes = [context.Process(target=_load_last_row, args=(path, n, barrier, results)) for _ in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        assert [process.exitcode for process in processes] == [0] * 4
+        assert [results.get() for _ in processes] == [f'q{n - 1}'] * 4
+    assert sorted(os.listdir(tmp_path)) == ['qas.jsonl', 'qas.jsonl.offsets.npy']
+
+
+def test_load_line_offsets_rebuilds_stale_index(tmp_path):
+    path = tmp_path / 'qas.jsonl'
+    write_jsonl(path, [{'question': 'a'}])
+    assert len(load_line_offsets(str(path))) == 1
+
+    write_jsonl(path, [{'question': 'a'}, {'question': 'b'}, {'question': 'c'}])
+    assert len(load_line_offsets(str(path))) == 3
+    assert load_jsonl_rows([str(path)], [2])[2] == {'question': 'c'}
+
+
+def test_line_count(tmp_path):
+    path = tmp_path / 'qas.jsonl'
+    write_jsonl(path, [{'question': str(i)} for i in range(1000)])
+    assert line_count(str(path)) == 1000
+
+    with open(path, 'a') as f:
+        f.write('{"question": "last"}')  # no trailing newline, like `wc -l`
+    assert line_count(str(path)) == 1000
+
+    assert (tmp_path / 'qas.jsonl.line_count.json').exists()
+
+    empty = tmp_path / 'empty.jsonl'
+    empty.write_text('')
+    assert line_count(str(empty)) == 0
+
+
+def test_compact_results(tmp_path):
+    corpus = tmp_path / 'corpus.jsonl'
+    questions = tmp_path / 'questions.jsonl'
+    write_jsonl(corpus, [{'question': f'q{i}', 'answer': [f'a{i}']} for i in range(10)])
+    write_jsonl(questions, [{'question': 'x'}, {'question': 'y'}])
+
+    path = str(tmp_path / 'results.npz')
+    dump_compact_results(path, [[3, 1], [9, -1]], [[0.5, 0.25], [2.0, 0.0]], [str(corpus)], str(questions))
+    results = list(load_retrieval_results(path))
+
+    assert results[0] == {'input_qa': {'question': 'x'},
+                          'retrieved_qas': [{'question': 'q3', 'answer': ['a3'], 'score': 0.5},
+                                            {'question': 'q1', 'answer': ['a1'], 'score': 0.25}]}
+    assert results[1]['retrieved_qas'] == [{'question': 'q9', 'answer': ['a9'], 'score': 2.0}]
+
+
+def test_iter_jsonl_chunks(tmp_path):
+    path = tmp_path / 'qas.jsonl'
+    write_jsonl(path, [{'question': str(i)} for i in range(7)])
+
+    chunks = list(iter_jsonl_chunks(str(path), 3, start=2))
+    assert [[qa['question'] for qa in chunk] for chunk in chunks] == [['2', '3', '4'], ['5', '6']]
+    assert list(iter_jsonl_chunks(str(path), 3, start=7)) == []
+
+
+def test_open_jsonl_gzip(tmp_path):
+    path = str(tmp_path / 'results.jsonl.gz')
+    with open_jsonl(path, mode='w') as writer:
+        writer.write_all([{'question': 'a'}, {'question': 'b'}])
+    assert load_jsonl(path) == [{'question': 'a'}, {'question': 'b'}]
+    assert list(load_retrieval_results(path)) == [{'question': 'a'}, {'question': 'b'}]
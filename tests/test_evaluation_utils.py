@@ -1,4 +1,7 @@
-from utils.evaluation_utils import exact_match_score_normalized, exact_match_amount, ems, metric_max_over_ground_truths
+import json
+
+from utils.evaluation_utils import exact_match_score_normalized, exact_match_amount, ems, metric_max_over_ground_truths, \
+    em_at_k, score_retrieved_qas, parse_date, build_answer_index, load_answer_index, answer_index_path, rank_matches
 
 
 def test_exact_match_score_normalized():
@@ -10,6 +13,18 @@ def test_exact_match_score_normalized():
     assert exact_match_score_normalized('October 2021', 'October 2021') is True
 
 
+def test_parse_date():
+    assert parse_date('2 December 2021') == (2021, 12, 2, 'day')
+    assert parse_date('December 02, 2021') == (2021, 12, 2, 'day')
+    assert parse_date('December 2 2021') == (2021, 12, 2, 'day')
+    assert parse_date('December 2021') == (2021, 12, 1, 'month')
+    assert parse_date('21') == (21, 1, 1, 'year')
+    assert parse_date('29 February 2021') is None
+    assert parse_date('0000') is None
+    assert parse_date('december 2021') is None
+    assert parse_date('Super Bowl 2021') is None
+
+
 def test_exact_match_amount():
     assert exact_match_amount('25', '250') is False
     assert exact_match_amount('twenty five', '250') is False
@@ -33,3 +48,50 @@ def test_exact_match_amount():
 
 def test_metric_max_over_ground_truths():
     assert metric_max_over_ground_truths(ems, 'Los Angeles Dodgers', ['Los Angeles Dodgers'], "") is True
+
+
+def test_em_at_k():
+    assert em_at_k([False, False, True], (1, 2, 3, 50)) == {1: 0, 2: 0, 3: 1, 50: 1}
+    assert em_at_k([], (1, 5)) == {1: 0, 5: 0}
+
+
+def test_score_retrieved_qas():
+    qa = {
+        'question': 'how many seasons of the wire are there',
+        'retrieved_qas': [{'answer': ['four'], 'score': 2.5}] + [{'answer': ['5 seasons'], 'score': 1.0}] * 9,
+    }
+    qa = score_retrieved_qas(qa, ['Five'], ['Five', '5'])
+    assert qa['retrieved_qa_score'] == 2.5
+    assert [qa[f'em_{k}'] for k in [1, 5, 10, 50]] == [0, 0, 0, 0]
+    assert [qa[f'em_n_{k}'] for k in [1, 5, 10, 50]] == [0, 1, 1, 1]
+
+
+def test_answer_index(tmp_path):
+    path = tmp_path / 'relation.jsonl'
+    answers = ['December 2, 2021', 'the 2021', 'twenty five', 'Los Angeles Dodgers']
+    with open(path, 'w') as f:
+        for answer in answers:
+            f.write(json.dumps({'question': 'q', 'answer': [answer]}) + '\n')
+    build_answer_index(str(path), n_jobs=1)
+    answer_index = load_answer_index(answer_index_path(str(path)))
+    assert sorted(answer_index) == sorted(answers)
+
+    predictions = answers + ['December 2021']
+    for question, ground_truths in [('how many', ['25']), ('when', ['December 2021']), ('who', ['2021'])]:
+        assert rank_matches(predictions, ground_truths, question, normalized=True, answer_index=answer_index) == \
+               rank_matches(predictions, ground_truths, question, normalized=True)
+
+
+def test_build_answer_index_interrupted(tmp_path, monkeypatch):
+    path = tmp_path / 'relation.jsonl'
+    path.write_text(json.dumps({'question': 'q', 'answer': ['2021']}) + '\n')
+
+    def interrupted(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr('utils.evaluation_utils.np.savez', interrupted)
+    try:
+        build_answer_index(str(path), n_jobs=1)
+    except KeyboardInterrupt:
+        pass
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['relation.jsonl']
@@ -0,0 +1,33 @@
+import sqlite3
+
+from utils.wikidata_labels import SQLITE_MAX_VARIABLES, WikidataLabels, _is_key_indexed, create_label_index
+
+
+def create_labels(path, n):
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE labels (key TEXT, value TEXT)")
+        connection.executemany("INSERT INTO labels VALUES (?, ?)", [(f'Q{i}', f'label {i}') for i in range(n)])
+
+
+def test_get_many(tmp_path):
+    path = str(tmp_path / 'labels')
+    n = 2 * SQLITE_MAX_VARIABLES + 10
+    create_labels(path, n)
+    labels = WikidataLabels(path)
+
+    ids = [f'Q{i}' for i in range(n)] + ['Q1', 'Q_missing']
+    mapping = labels.get_many(ids)
+    assert len(mapping) == n and mapping['Q1'] == 'label 1' and 'Q_missing' not in mapping
+
+    assert labels.get_many(['Q2', 'Q_missing']) == {'Q2': 'label 2'}
+    assert labels.lru.info()['hits'] == 2
+    labels.close()
+
+
+def test_create_label_index(tmp_path):
+    path = str(tmp_path / 'labels')
+    create_labels(path, 10)
+    create_label_index(path)
+    create_label_index(path)
+    with sqlite3.connect(path) as connection:
+        assert _is_key_indexed(connection)
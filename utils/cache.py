@@ -1,32 +1,226 @@
 import functools
+import hashlib
+import os
+import sys
+import time
+from collections import OrderedDict
+
 from diskcache import Cache
 
 CACHES = []
-def cache(name, directory='.cache'):
-    """Keep a cache of previous function calls that persists on disk"""
+CACHE_INFOS = {}
+MEMOS = {}
+_MISSING = object()
+
+
+def _sizeof(obj):
+    """Approximate memory size of a value, counting the items of tuples"""
+    if isinstance(obj, tuple):
+        return sys.getsizeof(obj) + sum(_sizeof(item) for item in obj)
+    return sys.getsizeof(obj)
+
+
+class LRUCache:
+    """
+    In memory cache that evicts least recently used items beyond `maxsize` items or `max_bytes` bytes, and items
+    older than `ttl` seconds
+    """
+
+    def __init__(self, maxsize=2 ** 16, max_bytes=None, ttl=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.expires = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        value = self.data.get(key, _MISSING)
+        if value is not _MISSING and self.ttl is not None and self.expires[key] < time.monotonic():
+            self._pop(key)
+            value = _MISSING
+        if value is _MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        if key in self.data:
+            self._pop(key)
+        self.data[key] = value
+        self.bytes += _sizeof(key) + _sizeof(value)
+        if self.ttl is not None:
+            self.expires[key] = time.monotonic() + self.ttl
+        while self.data and ((self.maxsize is not None and len(self.data) > self.maxsize)
+                             or (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            self._pop(next(iter(self.data)))
+
+    def _pop(self, key):
+        value = self.data.pop(key)
+        self.expires.pop(key, None)
+        self.bytes -= _sizeof(key) + _sizeof(value)
+
+    def clear(self):
+        self.data.clear()
+        self.expires.clear()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'items': len(self.data), 'bytes': self.bytes}
+
+
+def memoize(maxsize=2 ** 16, max_bytes=None, key=None):
+    """
+    Keep a bounded in memory cache of previous function calls. `key` maps the call arguments to the cache key,
+    so calls that are known to give the same result can share an entry.
+    """
+
+    def decorator_memoize(func):
+        lru = LRUCache(maxsize, max_bytes)
+
+        @functools.wraps(func)
+        def wrapper_memoize(*args, **kwargs):
+            cache_key = key(*args, **kwargs) if key is not None else args + tuple(kwargs.items())
+            value = lru.get(cache_key, _MISSING)
+            if value is _MISSING:
+                value = func(*args, **kwargs)
+                lru.set(cache_key, value)
+            return value
+
+        wrapper_memoize.cache = lru
+        wrapper_memoize.cache_info = lru.info
+        wrapper_memoize.cache_clear = lru.clear
+        MEMOS[f'{func.__module__}.{func.__qualname__}'] = lru
+        return wrapper_memoize
+
+    return decorator_memoize
+
+
+def memo_info():
+    """Hit/miss counts and sizes of all memoized functions"""
+    return {name: lru.info() for name, lru in MEMOS.items()}
+
+
+def file_stat(path):
+    """(path, size, mtime) of a file, as a cache dependency that changes when the file is written"""
+    stat = os.stat(path)
+    return path, stat.st_size, stat.st_mtime_ns
+
+
+@memoize(maxsize=2 ** 10)
+def _file_hash(path, size, mtime, chunk_size=2 ** 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_hash(path):
+    """sha1 of the contents of a file, as a cache dependency that only changes when the contents change"""
+    return path, _file_hash(*file_stat(path))
+
+
+def cache(name, directory='.cache', depends_on=None, size_limit=None, eviction_policy=None, memory_maxsize=None,
+          memory_ttl=None):
+    """
+    Keep a cache of previous function calls that persists on disk.
+    `depends_on` maps the call arguments to a value that is part of the cache key, e.g. the file_stat or file_hash
+    of an input file, so entries are not used after it changed. `size_limit` (bytes) and `eviction_policy`
+    ('least-recently-stored', 'least-recently-used' or 'least-frequently-used') configure the diskcache.
+    With `memory_maxsize`, up to that many entries are also kept in memory for at most `memory_ttl` seconds, which
+    requires hashable arguments and callers that do not modify the returned values.
+    """
 
     def decorator_cache(func):
+        stats = {'hits': 0, 'misses': 0}
+        memory = LRUCache(memory_maxsize, ttl=memory_ttl) if memory_maxsize is not None else None
+
+        def make_key(args, kwargs):
+            cache_key = args + tuple(kwargs.items())
+            if depends_on is not None:
+                cache_key += (('depends_on', depends_on(*args, **kwargs)),)
+            return cache_key
+
+        def lookup(cache_key):
+            value = memory.get(cache_key, _MISSING) if memory is not None else _MISSING
+            if value is _MISSING:
+                value = wrapper_cache.cache.get(cache_key, default=_MISSING)
+                if value is not _MISSING and memory is not None:
+                    memory.set(cache_key, value)
+            stats['hits' if value is not _MISSING else 'misses'] += 1
+            return value
+
+        def store(cache_key, value):
+            wrapper_cache.cache[cache_key] = value
+            if memory is not None:
+                memory.set(cache_key, value)
+
         @functools.wraps(func)
         def wrapper_cache(*args, **kwargs):
-            cache_key = args + tuple(kwargs.items())
-            if cache_key not in wrapper_cache.cache:
-                wrapper_cache.cache[cache_key] = func(*args, **kwargs)
-            return wrapper_cache.cache[cache_key]
+            cache_key = make_key(args, kwargs)
+            value = lookup(cache_key)
+            if value is _MISSING:
+                value = func(*args, **kwargs)
+                store(cache_key, value)
+            return value
 
-        wrapper_cache.cache = Cache(directory + '/' + name)
+        settings = {'size_limit': size_limit, 'eviction_policy': eviction_policy}
+        wrapper_cache.cache = Cache(directory + '/' + name,
+                                    **{key: value for key, value in settings.items() if value is not None})
         CACHES.append(wrapper_cache.cache)
 
+        def get_many(calls):
+            """Cached results of a list of calls, given as argument tuples, in a single transaction"""
+            results = {}
+            with wrapper_cache.cache.transact():
+                for args in calls:
+                    value = lookup(make_key(tuple(args), {}))
+                    if value is not _MISSING:
+                        results[args] = value
+            return results
+
+        def set_many(results):
+            """Store the results of calls, given as a dict from argument tuples to results, in a single transaction"""
+            with wrapper_cache.cache.transact():
+                for args, value in results.items():
+                    store(make_key(tuple(args), {}), value)
+
         def cache_clear():
             """Clear the cache"""
             wrapper_cache.cache.clear()
+            if memory is not None:
+                memory.clear()
 
         def cache_close():
             """Close the diskcache"""
             wrapper_cache.cache.close()
 
+        def cache_info():
+            """Hits and misses of this process, and the number of items and bytes on disk"""
+            info = {**stats, 'items': len(wrapper_cache.cache), 'bytes': wrapper_cache.cache.volume()}
+            if memory is not None:
+                info['memory'] = memory.info()
+            return info
+
+        wrapper_cache.get_many = get_many
+        wrapper_cache.set_many = set_many
         wrapper_cache.cache_clear = cache_clear
         wrapper_cache.cache_close = cache_close
+        wrapper_cache.cache_info = cache_info
+        CACHE_INFOS[name] = cache_info
 
         return wrapper_cache
 
     return decorator_cache
+
+
+def cache_info():
+    """Hit/miss counts and sizes of all disk caches"""
+    return {name: info() for name, info in CACHE_INFOS.items()}
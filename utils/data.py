@@ -1,5 +1,12 @@
+import gzip
 import json
+import mmap
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
+import numpy as np
 from jsonlines import jsonlines
 
 
@@ -19,9 +26,224 @@ def dump_jsonl(items, fi):
             f.write(json.dumps(item) + '\n')
 
 
+def open_jsonl(path, mode='r'):
+    """jsonlines.open that (de)compresses files ending with .gz"""
+    if not str(path).endswith('.gz'):
+        return jsonlines.open(path, mode=mode)
+    fp = gzip.open(path, mode=f'{mode}t', encoding='utf-8', compresslevel=1)
+    instance = jsonlines.Reader(fp) if mode == 'r' else jsonlines.Writer(fp)
+    instance._should_close_fp = True
+    return instance
+
+
 def load_jsonl(fi):
     out = []
-    with jsonlines.open(fi, mode='r') as reader:
+    with open_jsonl(fi, mode='r') as reader:
         for k, item in enumerate(reader):
             out.append(item)
     return out
+
+
+def file_signature(path):
+    """(size, mtime) of a file, used to detect when a sidecar file is stale"""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _count_newlines(buffer, start, end, chunk_size=64 * 1024 * 1024):
+    count = 0
+    for position in range(start, end, chunk_size):
+        chunk = np.frombuffer(buffer, dtype=np.uint8, count=min(chunk_size, end - position), offset=position)
+        count += int(np.count_nonzero(chunk == ord('\n')))
+        del chunk  # release the buffer export so the mmap can be closed
+    return count
+
+
+def _count_lines(path, size):
+    if size == 0:
+        return 0
+
+    n_jobs = os.cpu_count() or 1
+    step = -(-size // n_jobs)
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        with ThreadPoolExecutor(n_jobs) as executor:
+            counts = executor.map(lambda start: _count_newlines(buffer, start, min(start + step, size)),
+                                  range(0, size, step))
+            return sum(counts)
+
+
+def line_count(path):
+    """
+    Count the newlines in a file in parallel. The count is stored next to the file in `<path>.line_count.json`
+    with the (size, mtime) it was counted for, so every job reading the file can reuse it.
+    """
+    count_path = f'{path}.line_count.json'
+    size, mtime = file_signature(path)
+    if os.path.exists(count_path):
+        try:
+            stored = load_json(count_path)
+            if (stored['size'], stored['mtime']) == (size, mtime):
+                return stored['count']
+        except (ValueError, KeyError):
+            pass
+
+    count = _count_lines(path, size)
+    try:
+        with atomic_write(count_path) as f:
+            f.write(json.dumps({'size': size, 'mtime': mtime, 'count': count}).encode())
+    except OSError:
+        pass  # e.g. a read-only data directory, the count is just not stored
+    return count
+
+
+@contextmanager
+def atomic_write(path):
+    """
+    Open a temporary file, unique to this writer, that replaces `path` once it is completely written. Concurrent
+    writers of the same path do not interfere, the last one to finish wins.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    f = tempfile.NamedTemporaryFile(dir=directory, prefix=f'.{name}.', suffix='.tmp', delete=False)
+    try:
+        with f:
+            yield f
+        os.replace(f.name, path)
+    except BaseException:
+        if os.path.exists(f.name):
+            os.unlink(f.name)
+        raise
+
+
+def build_line_offsets(path, chunk_size=64 * 1024 * 1024):
+    """
+    Scan a file once and store the byte offset of every line start in `<path>.offsets.npy`, after the (size, mtime)
+    of the file it was built from
+    """
+    signature = file_signature(path)
+    offsets = [np.array(signature, dtype=np.uint64), np.zeros(1, dtype=np.uint64)]
+    position = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+            offsets.append((newlines + position + 1).astype(np.uint64))
+            position += len(chunk)
+    offsets = np.concatenate(offsets)
+    if offsets[-1] == signature[0]:  # no line starts after the final newline
+        offsets = offsets[:-1]
+
+    with atomic_write(f'{path}.offsets.npy') as f:
+        np.save(f, offsets)
+    return offsets[2:]
+
+
+def _load_current_line_offsets(path):
+    offsets_path = f'{path}.offsets.npy'
+    if os.path.exists(offsets_path):
+        offsets = np.load(offsets_path, mmap_mode='r')
+        if len(offsets) >= 2 and tuple(offsets[:2].tolist()) == file_signature(path):
+            return offsets[2:]
+    return None
+
+
+def load_line_offsets(path):
+    """Memory-map the line offset index of a file, (re)building it if missing or stale"""
+    offsets = _load_current_line_offsets(path)
+    if offsets is None:
+        offsets = build_line_offsets(path)
+        # Concurrent builds write identical indices, memory-map whichever one was renamed into place last
+        current = _load_current_line_offsets(path)
+        if current is not None:
+            offsets = current
+    return offsets
+
+
+def load_jsonl_rows(paths, indices):
+    """Load the given rows of a list of jsonl files that are numbered consecutively across files"""
+    indices = np.unique(np.asarray(indices, dtype=np.int64))
+    results = {}
+    start = 0
+    for path in paths:
+        offsets = load_line_offsets(path)
+        end = start + len(offsets)
+        file_indices = indices[(indices >= start) & (indices < end)]
+        with open(path, 'rb') as f:
+            for index in file_indices:
+                f.seek(int(offsets[index - start]))
+                results[int(index)] = json.loads(f.readline())
+        start = end
+    return results
+
+
+def iter_jsonl_chunks(path, chunk_size, start=0):
+    """Iterate a jsonl file in lists of `chunk_size` items, starting at line `start`"""
+    offsets = load_line_offsets(path)
+    if start >= len(offsets):
+        return
+    with open(path, 'rb') as f:
+        f.seek(int(offsets[start]))
+        chunk = []
+        for line in f:
+            chunk.append(json.loads(line))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+
+def pack_strings(strings):
+    """Pack strings into a single utf-8 byte array, along with the offsets of every string in it"""
+    encoded = [string.encode() for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def unpack_strings(data, offsets):
+    data = data.tobytes()
+    return [data[start:end].decode() for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+def dump_compact_results(path, top_indices, top_scores, qas_to_retrieve_from_paths, qas_to_answer_path):
+    """
+    Write retrieval results as numpy columns instead of jsonl, the retrieved QA-pairs are referenced by their
+    row in `qas_to_retrieve_from_paths`. Row i, column j of `corpus_row_id` and `score` is the rank j result of
+    question i.
+    """
+    with open(path, 'wb') as f:
+        np.savez(
+            f,
+            corpus_row_id=np.asarray(top_indices, dtype=np.int64),
+            score=np.asarray(top_scores, dtype=np.float32),
+            qas_to_retrieve_from_paths=np.array([os.path.abspath(p) for p in qas_to_retrieve_from_paths]),
+            qas_to_answer_path=np.array(os.path.abspath(qas_to_answer_path)),
+        )
+
+
+def load_compact_results(path, chunk_size=1024):
+    """Iterate results written by dump_compact_results in the jsonl output format, resolving QA-pairs lazily"""
+    with np.load(path) as results:
+        top_indices = results['corpus_row_id']
+        top_scores = results['score']
+        qas_to_retrieve_from_paths = [str(p) for p in results['qas_to_retrieve_from_paths']]
+        qas_to_answer_path = str(results['qas_to_answer_path'])
+
+    for start in range(0, len(top_indices), chunk_size):
+        end = min(start + chunk_size, len(top_indices))
+        retrieved_qas = load_jsonl_rows(qas_to_retrieve_from_paths, top_indices[start:end].ravel())
+        input_qas = load_jsonl_rows([qas_to_answer_path], range(start, end))
+        for i in range(start, end):
+            yield {
+                'input_qa': input_qas[i],
+                'retrieved_qas': [{**retrieved_qas[ind], 'score': float(score)}
+                                  for ind, score in zip(top_indices[i], top_scores[i]) if ind >= 0],
+            }
+
+
+def load_retrieval_results(path):
+    """Iterate retrieval results from a jsonl or compact (.npz) results file"""
+    if path.endswith('.npz'):
+        yield from load_compact_results(path)
+    else:
+        with open_jsonl(path) as reader:
+            yield from reader
@@ -1,29 +1,32 @@
 import functools
+import itertools
+import multiprocessing
+import os
 import re
 import string
+from collections import namedtuple
 from typing import Union, List
 from datetime import datetime
 
+import numpy as np
+from jsonlines import jsonlines
 from regex import regex
 import number_parser
 import pendulum
 
-# Normalization from SQuAD evaluation script https://worksheets.codalab.org/rest/bundles/0x6b567e1cf2e041ec80d7098f031c5c9e/contents/blob/
-def normalize_answer(s):
-    def remove_articles(text):
-        return regex.sub(r'\b(a|an|the)\b', ' ', text)
+from utils.cache import memoize
+from utils.data import atomic_write, pack_strings, unpack_strings
+from utils.utils import unique
 
-    def white_space_fix(text):
-        return ' '.join(text.split())
+ARTICLES_PATTERN = regex.compile(r'\b(a|an|the)\b')
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
 
-    def remove_punc(text):
-        exclude = set(string.punctuation)
-        return ''.join(ch for ch in text if ch not in exclude)
 
-    def lower(text):
-        return text.lower()
-
-    return white_space_fix(remove_articles(remove_punc(lower(s))))
+# Normalization from SQuAD evaluation script https://worksheets.codalab.org/rest/bundles/0x6b567e1cf2e041ec80d7098f031c5c9e/contents/blob/
+@functools.lru_cache(maxsize=2 ** 20)
+def normalize_answer(s):
+    """Lower case, remove punctuation, articles and extra whitespace"""
+    return ' '.join(ARTICLES_PATTERN.sub(' ', s.lower().translate(PUNCTUATION_TABLE)).split())
 
 
 def exact_match_score(prediction, ground_truth, question=""):
@@ -44,7 +47,27 @@ def potential_year(string):
     return year_pattern.search(string)
 
 
-@functools.lru_cache(maxsize=None)
+DATE_ARTICLES_PATTERN = regex.compile(r'\b(a|an|the|in|on)\b')
+AMOUNT_QUESTION_PATTERN = re.compile(r'^how (many|much) ')
+
+
+MONTHS = ('January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October',
+          'November', 'December')
+MONTH_NUMBERS = {month: i for i, month in enumerate(MONTHS, 1)}
+MONTH_PATTERN = regex.compile('|'.join(MONTHS))
+# The date formats accepted by pendulum, with the granularity at which a ground truth in that format is compared
+DATE_FORMATS = {'D MMMM YYYY': 'day', 'MMMM D, YYYY': 'day', 'MMMM D YYYY': 'day', 'MMMM YYYY': 'month',
+                'YYYY': 'year'}
+# Recognizes all DATE_FORMATS in a single match
+DATE_PATTERN = regex.compile(
+    rf'(?:(?P<day>\d{{1,2}}) (?P<month>{MONTH_PATTERN.pattern}) '
+    rf'|(?P<month2>{MONTH_PATTERN.pattern}) (?P<day2>\d{{1,2}}),? '
+    rf'|(?P<month3>{MONTH_PATTERN.pattern}) )?'
+    r'(?P<year>\d{1,4})\n?'
+)
+
+
+@memoize(maxsize=2 ** 18, max_bytes=2 ** 26)
 def try_parsing_date(text, formats):
     for fmt in formats:
         try:
@@ -54,44 +77,75 @@ def try_parsing_date(text, formats):
     raise ValueError('No valid date format found')
 
 
-@functools.lru_cache(maxsize=None)
+def _parse_date_pendulum(text):
+    for fmt, granularity in DATE_FORMATS.items():
+        try:
+            date = try_parsing_date(text, (fmt,))
+            return date.year, date.month, date.day, granularity
+        except ValueError:
+            pass
+    return None
+
+
+def parse_date(text):
+    """
+    Parse text in one of the DATE_FORMATS to (year, month, day, granularity), month and day default to 1.
+    Returns None if text is not a valid date.
+    """
+    m = DATE_PATTERN.fullmatch(text)
+    if m is None:
+        # Only text with a month name can still be a date pendulum understands
+        return _parse_date_pendulum(text) if MONTH_PATTERN.search(text) else None
+
+    day = m.group('day') or m.group('day2')
+    month = m.group('month') or m.group('month2') or m.group('month3')
+    try:
+        date = datetime(int(m.group('year')), MONTH_NUMBERS[month] if month else 1, int(day) if day else 1)
+    except ValueError:
+        return None
+    return date.year, date.month, date.day, 'day' if day else 'month' if month else 'year'
+
+
+def remove_date_articles(text):
+    return DATE_ARTICLES_PATTERN.sub(' ', text).strip()
+
+
 def exact_match_date(prediction, ground_truth):
-    def remove_articles(text):
-        return regex.sub(r'\b(a|an|the|in|on)\b', ' ', text).strip()
+    return _exact_match_date(remove_date_articles(prediction), remove_date_articles(ground_truth),
+                             potential_year(ground_truth) is not None)
 
-    pred = remove_articles(prediction)
-    gt = remove_articles(ground_truth)
+
+@memoize(maxsize=2 ** 20, max_bytes=2 ** 28)
+def _exact_match_date(pred, gt, ground_truth_potential_year):
     if pred == gt:
         return True
 
-    if not (potential_year(pred) and potential_year(ground_truth)):  # speed up
+    if not (potential_year(pred) and ground_truth_potential_year):  # speed up
         return False
 
-    try:
-        prediction_date = try_parsing_date(pred, ('D MMMM YYYY', 'MMMM D, YYYY', 'MMMM D YYYY', 'MMMM YYYY', 'YYYY'))
-    except ValueError as e:
+    prediction_date = parse_date(pred)
+    if prediction_date is None:
         return False
 
-    try:
-        ground_truth_date = try_parsing_date(gt, ('D MMMM YYYY', 'MMMM D, YYYY', 'MMMM D YYYY',))
-        return ground_truth_date.date() == prediction_date.date()
-    except ValueError:
-        pass
+    ground_truth_date = parse_date(gt)
+    if ground_truth_date is None:
+        return False
 
-    try:
-        ground_truth_date = try_parsing_date(gt, ('MMMM YYYY',))
-        return ground_truth_date.month == prediction_date.month and ground_truth_date.year == prediction_date.year
-    except ValueError:
-        pass
+    return dates_match(prediction_date, ground_truth_date)
 
-    try:
-        ground_truth_date = try_parsing_date(gt, ('YYYY',))
-        return ground_truth_date.year == prediction_date.year
-    except ValueError:
-        return False
 
+def dates_match(prediction_date, ground_truth_date):
+    """Compare two parse_date results at the granularity of the ground truth"""
+    *prediction_date, _ = prediction_date
+    *ground_truth_date, granularity = ground_truth_date
+    if granularity == 'day':
+        return ground_truth_date == prediction_date
+    if granularity == 'month':
+        return ground_truth_date[:2] == prediction_date[:2]
+    return ground_truth_date[0] == prediction_date[0]
 
-@functools.lru_cache(maxsize=None)
+
+@memoize(maxsize=2 ** 18, max_bytes=2 ** 26)
 def extract_amount(text):
     text = number_parser.parse(text)
     text = re.sub("[^0-9.]", "", text)  # remove all non number characters
@@ -109,21 +163,124 @@ def exact_match_amount(prediction, ground_truth):
     return prediction_amount == ground_truth_amount and prediction_amount is not None
 
 
-@functools.lru_cache(maxsize=None)
 def exact_match_score_normalized(prediction, ground_truth, question=""):
+    return _exact_match_score_normalized(prediction, ground_truth, AMOUNT_QUESTION_PATTERN.match(question) is not None)
+
+
+@memoize(maxsize=2 ** 20, max_bytes=2 ** 28)
+def _exact_match_score_normalized(prediction, ground_truth, amount_question):
     if normalize_answer(prediction) == normalize_answer(ground_truth):
         return True
 
     if exact_match_date(prediction, ground_truth):
         return True
 
-    if re.match(r'^how (many|much) ', question):
+    if amount_question:
         if exact_match_amount(prediction, ground_truth):
             return True
 
     return False
 
 
+AnswerKeys = namedtuple('AnswerKeys', ['answer', 'normalized', 'date_text', 'has_year', 'date_text_has_year', 'date',
+                                       'amount', 'amount_parsed'])
+GRANULARITIES = (None, 'year', 'month', 'day')
+
+
+def _answer_keys(answer, parse_amount=False):
+    date_text = remove_date_articles(answer)
+    has_year = potential_year(answer) is not None
+    date_text_has_year = potential_year(date_text) is not None
+    return AnswerKeys(
+        answer=answer,
+        normalized=normalize_answer(answer),
+        date_text=date_text,
+        has_year=has_year,
+        date_text_has_year=date_text_has_year,
+        date=parse_date(date_text) if has_year or date_text_has_year else None,
+        amount=extract_amount(answer) if parse_amount else None,
+        amount_parsed=parse_amount,
+    )
+
+
+@memoize(maxsize=2 ** 20, max_bytes=2 ** 28)
+def answer_keys(answer):
+    """Everything exact_match_score_normalized derives from an answer, except its amount which is parsed lazily"""
+    return _answer_keys(answer)
+
+
+def _amount(keys):
+    return keys.amount if keys.amount_parsed else extract_amount(keys.answer)
+
+
+def exact_match_answer_keys(prediction, ground_truth, amount_question):
+    """exact_match_score_normalized on AnswerKeys instead of text"""
+    if prediction.normalized == ground_truth.normalized or prediction.date_text == ground_truth.date_text:
+        return True
+
+    if prediction.date_text_has_year and ground_truth.has_year and prediction.date and ground_truth.date:
+        if dates_match(prediction.date, ground_truth.date):
+            return True
+
+    if amount_question:
+        amount = _amount(prediction)
+        return amount is not None and amount == _amount(ground_truth)
+
+    return False
+
+
+def answer_index_path(qas_path):
+    return f'{os.path.splitext(qas_path)[0]}.answers.npz'
+
+
+def _corpus_answer_keys(answer):
+    return _answer_keys(answer, parse_amount=True)
+
+
+def build_answer_index(qas_path, n_jobs=None):
+    """
+    Precompute the AnswerKeys of the answers of a QA-pair corpus, so evaluation does not re-parse them for every
+    retrieval. They are written as columns next to the corpus, see answer_index_path.
+    """
+    with jsonlines.open(qas_path) as reader:
+        answers = unique(qa['answer'][0] for qa in reader)
+    keys = list(map_qas(_corpus_answer_keys, answers, n_jobs, chunksize=1024))
+
+    columns = {}
+    for name in ['answer', 'normalized', 'date_text']:
+        columns[name], columns[f'{name}_offsets'] = pack_strings([getattr(k, name) for k in keys])
+    with atomic_write(answer_index_path(qas_path)) as f:
+        np.savez(
+            f,
+            **columns,
+            has_year=np.array([k.has_year for k in keys], dtype=bool),
+            date_text_has_year=np.array([k.date_text_has_year for k in keys], dtype=bool),
+            date=np.array([k.date[:3] if k.date else (0, 0, 0) for k in keys], dtype=np.int32).reshape(-1, 3),
+            granularity=np.array([GRANULARITIES.index(k.date[3] if k.date else None) for k in keys], dtype=np.int8),
+            amount=np.array([np.nan if k.amount is None else k.amount for k in keys], dtype=np.float64),
+        )
+
+
+def load_answer_index(path):
+    """Load the AnswerKeys written by build_answer_index, by answer"""
+    with np.load(path) as columns:
+        strings = {name: unpack_strings(columns[name], columns[f'{name}_offsets'])
+                   for name in ['answer', 'normalized', 'date_text']}
+        has_year = columns['has_year'].tolist()
+        date_text_has_year = columns['date_text_has_year'].tolist()
+        dates = columns['date'].tolist()
+        granularities = [GRANULARITIES[g] for g in columns['granularity'].tolist()]
+        amounts = columns['amount'].tolist()
+
+    return {
+        answer: AnswerKeys(answer, normalized, date_text, has_year[i], date_text_has_year[i],
+                           (*dates[i], granularities[i]) if granularities[i] else None,
+                           None if np.isnan(amounts[i]) else amounts[i], True)
+        for i, (answer, normalized, date_text) in
+        enumerate(zip(strings['answer'], strings['normalized'], strings['date_text']))
+    }
+
+
 def ems_norm(prediction, ground_truths, question=""):
     return max([exact_match_score_normalized(prediction, gt, question) for gt in ground_truths])
 
@@ -149,4 +306,72 @@ def metric_max_over_ground_truths(metric_fn, predictions: Union[str, List[str]],
             score = metric_fn(prediction, ground_truth, question)
             scores_for_ground_truths.append(score)
 
-    return max(scores_for_ground_truths)
\ No newline at end of file
+    return max(scores_for_ground_truths)
+
+
+EM_KS = (1, 5, 10, 50)
+
+
+def rank_matches(predictions, ground_truths, question="", normalized=False, answer_index=None):
+    """
+    Whether each of a ranked list of predictions matches any of the ground truths. AnswerKeys of predictions found
+    in `answer_index` are used instead of parsing the predictions again.
+    """
+    if answer_index is not None:
+        return _rank_answer_key_matches(predictions, ground_truths, question, normalized, answer_index)
+
+    normalized_ground_truths = {normalize_answer(gt) for gt in ground_truths}
+    metric_fn = exact_match_score_normalized if normalized else exact_match_score
+
+    matches = {}
+    for prediction in predictions:
+        if prediction not in matches:
+            matches[prediction] = normalize_answer(prediction) in normalized_ground_truths or (
+                    normalized and any(metric_fn(prediction, gt, question) for gt in ground_truths))
+    return [matches[prediction] for prediction in predictions]
+
+
+def _rank_answer_key_matches(predictions, ground_truths, question, normalized, answer_index):
+    normalized_ground_truths = {normalize_answer(gt) for gt in ground_truths}
+    ground_truth_keys = [answer_keys(gt) for gt in ground_truths] if normalized else []
+    amount_question = AMOUNT_QUESTION_PATTERN.match(question) is not None
+
+    matches = {}
+    for prediction in predictions:
+        if prediction not in matches:
+            keys = answer_index.get(prediction)
+            if keys is None and normalized:
+                keys = answer_keys(prediction)
+            normalized_prediction = normalize_answer(prediction) if keys is None else keys.normalized
+            matches[prediction] = normalized_prediction in normalized_ground_truths or (
+                    normalized and any(exact_match_answer_keys(keys, gt, amount_question) for gt in ground_truth_keys))
+    return [matches[prediction] for prediction in predictions]
+
+
+def em_at_k(matches, ks=EM_KS):
+    """EM@k for every k, from the per rank matches of the predictions"""
+    cumulative = list(itertools.accumulate(matches, max))
+    return {k: int(bool(cumulative and cumulative[min(k, len(cumulative)) - 1])) for k in ks}
+
+
+def score_retrieved_qas(qa, ground_truths, ground_truths_normalized, ks=EM_KS, answer_index=None):
+    """Add EM@k (`em_k`) and normalized EM@k (`em_n_k`) of the answers of `retrieved_qas` to a qa"""
+    predictions = [retrieved_qa['answer'][0] for retrieved_qa in qa['retrieved_qas'][:max(ks)]]
+    em = em_at_k(rank_matches(predictions, ground_truths, qa['question'], answer_index=answer_index), ks)
+    em_n = em_at_k(rank_matches(predictions, ground_truths_normalized, qa['question'], normalized=True,
+                                answer_index=answer_index), ks)
+
+    qa['retrieved_qa_score'] = qa['retrieved_qas'][0]['score']
+    for k in ks:
+        qa[f'em_n_{k}'] = em_n[k]
+        qa[f'em_{k}'] = em[k]
+    return qa
+
+
+def map_qas(fn, qas, n_jobs=None, chunksize=64):
+    """Lazily apply `fn` to every qa in a process pool, keeping the order of `qas`"""
+    if n_jobs == 1:
+        yield from map(fn, qas)
+        return
+    with multiprocessing.Pool(n_jobs) as pool:
+        yield from pool.imap(fn, qas, chunksize=chunksize)
@@ -6,7 +6,7 @@ from utils.cache import cache
 
 sparql = SPARQLWrapper2("https://query.wikidata.org/sparql")
 
-@cache('wikidata_query')
+@cache('wikidata_query', memory_maxsize=2 ** 12)
 @retry(wait_exponential_multiplier=500, stop_max_attempt_number=5, wait_exponential_max=15000)
 def wikidata_query(query):
     try:
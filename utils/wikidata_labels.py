@@ -0,0 +1,79 @@
+# Resolves Wikidata ids to labels from the local labels database
+import logging
+import sqlite3
+
+from utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Max number of ? parameters of a query in older SQLite versions
+SQLITE_MAX_VARIABLES = 999
+_MISSING = object()
+
+
+def _is_key_indexed(connection):
+    for index in connection.execute("PRAGMA index_list(labels)").fetchall():
+        columns = [column[2] for column in connection.execute(f"PRAGMA index_info('{index[1]}')").fetchall()]
+        if columns[:1] == ['key']:
+            return True
+    return False
+
+
+def create_label_index(path):
+    """Index the keys of the labels table, so lookups do not scan the whole table"""
+    with sqlite3.connect(path) as connection:
+        if not _is_key_indexed(connection):
+            logger.info(f'Creating an index on the keys of {path}')
+            connection.execute("CREATE INDEX labels_key ON labels (key)")
+
+
+class WikidataLabels:
+    """
+    Label lookups on a read-only connection to the labels database, with an in memory LRU of recently resolved ids
+    that is shared by all lookups, including ids without a label
+    """
+
+    def __init__(self, path, maxsize=2 ** 21):
+        self.path = path
+        self._connection = None
+        self.lru = LRUCache(maxsize)
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+            self._connection.execute("PRAGMA mmap_size = 1073741824")
+            if not _is_key_indexed(self._connection):
+                logger.warning(f'The keys of {self.path} are not indexed, run create_label_index to speed up lookups')
+        return self._connection
+
+    def get_many(self, ids):
+        """Labels by id of `ids`, ids without a label are left out"""
+        labels = {}
+        missing = []
+        for id_ in dict.fromkeys(ids):
+            label = self.lru.get(id_, _MISSING)
+            if label is _MISSING:
+                missing.append(id_)
+            elif label is not None:
+                labels[id_] = label
+
+        missing.sort()  # neighbouring keys share index pages
+        for start in range(0, len(missing), SQLITE_MAX_VARIABLES):
+            chunk = missing[start:start + SQLITE_MAX_VARIABLES]
+            found = dict(self.connection.execute(
+                "SELECT key, value FROM labels WHERE key IN (%s)" % ','.join('?' * len(chunk)), chunk).fetchall())
+            for id_ in chunk:
+                label = found.get(id_)
+                self.lru.set(id_, label)
+                if label is not None:
+                    labels[id_] = label
+        return labels
+
+    def get(self, id_):
+        return self.get_many([id_]).get(id_)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None